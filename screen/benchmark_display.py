@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Benchmark of the display pipeline on the simulated panel (EPD_BACKEND=simulated in waveshare_epd/epdconfig.py)
+# Times every stage of display.py : decode of a local picture or of a server framebuffer, getbuffer, init, SetLut,
+# display, partial display and sleep, then show_image end to end.
+# The simulated panel is instant by default, so only the Python side is measured; the panel time it would take is
+# reported separately. The frames shown by the simulated panel are checked, so a failure exits with an error.
+# Usage : python benchmark_display.py [repeats]
+
+import os
+import sys
+import time
+import tempfile
+
+# must be set before waveshare_epd is imported
+os.environ["EPD_BACKEND"] = "simulated"
+os.environ.setdefault("EPD_SIM_TIME_SCALE", "0")
+state_directory = tempfile.TemporaryDirectory()
+os.environ["EPD_STATE_DIR"] = state_directory.name
+
+from PIL import Image
+
+from waveshare_epd import epdconfig, epd7in5_V2
+from image_transform_local import Image_transform
+from framebuffer import compress, decompress
+from frame_diff import changed_regions, bounding_box, window
+import display
+
+panel = epdconfig.implementation
+
+
+def make_picture(path, megapixels=12):
+    # 4:3 picture with noise and a gradient, as costly to decode as a photo
+    height = int((megapixels * 1e6 * 3 / 4) ** 0.5)
+    width = int(height * 4 / 3)
+    image = Image.merge("RGB", [Image.effect_noise((width, height), 60).convert("L"),
+                                Image.linear_gradient("L").resize((width, height)),
+                                Image.radial_gradient("L").resize((width, height))])
+    image.save(path, "JPEG", quality=90)
+
+
+def measure(name, function, repeats):
+    timings = []
+    transfers = 0
+    spi_bytes = 0
+    simulated_ms = 0
+    for _ in range(repeats):
+        panel.reset_log()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+        transfers = len(panel.transfers)
+        spi_bytes = sum(len(data) for _, data in panel.transfers)
+        simulated_ms = panel.simulated_ms
+    print(f"{name:>18} {min(timings) * 1000:>10.2f} {sum(timings) / len(timings) * 1000:>10.2f} "
+          f"{transfers:>10} {spi_bytes:>10} {simulated_ms:>12.0f}")
+
+
+def check(condition, message):
+    if not condition:
+        raise SystemExit(f"Simulated panel check failed: {message}")
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    epd = epd7in5_V2.EPD()
+
+    with tempfile.TemporaryDirectory() as directory:
+        picture_path = os.path.join(directory, "picture.jpg")
+        make_picture(picture_path)
+        frame = Image_transform(imported_image=picture_path).render(fit="crop")
+        buffer = epd.getbuffer(frame)
+        payload = compress(buffer, "zlib")
+
+        # the same frame with a block of text changed, for partial refreshes
+        changed = bytearray(buffer)
+        for row in range(100, 140):
+            changed[row * 100 + 20:row * 100 + 60] = bytes(40)
+        changed = bytes(changed)
+        box = bounding_box(changed_regions(buffer, changed))
+
+        def partial():
+            epd.display_partial(window(buffer, *box), window(changed, *box), *box)
+
+        print(f"{'stage':>18} {'best (ms)':>10} {'mean (ms)':>10} {'transfers':>10} {'SPI bytes':>10} {'panel (ms)':>12}")
+        measure("decode picture", lambda: Image_transform(imported_image=picture_path).render(fit="crop"), repeats)
+        measure("decode zlib frame", lambda: decompress(payload, "zlib"), repeats)
+        measure("getbuffer", lambda: epd.getbuffer(frame), repeats)
+        measure("init", epd.init, repeats)
+        measure("SetLut", lambda: epd.SetLut(epd.LUT_VCOM_7IN5_V2, epd.LUT_WW_7IN5_V2, epd.LUT_BW_7IN5_V2,
+                                             epd.LUT_WB_7IN5_V2, epd.LUT_BB_7IN5_V2), repeats)
+        measure("display", lambda: epd.display(buffer), repeats)
+        check(bytes(panel.screen) == bytes(buffer), "full refresh")
+        check(panel.image().transpose(Image.ROTATE_270).tobytes() == frame.convert("1").tobytes(), "rotation")
+        measure("display_partial", partial, repeats)
+        check(bytes(panel.screen) == changed, "partial refresh")
+        measure("sleep", epd.sleep, repeats)
+
+        # show_image alternates between both frames, so that every run has something to refresh
+        frames = [buffer, changed]
+        measure("show_image", lambda: display.show_image(frames.append(frames.pop(0)) or frames[0]), repeats)
+        check(bytes(panel.screen) == frames[0], "show_image")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Benchmark of EPD.getbuffer, the packing of a frame into the 48000 bytes sent to the panel
+# Compares the per-byte loop of previous versions with the bulk operations used now.
+# Run it on the Pi, where the loop costs the most : python benchmark_getbuffer.py [repeats]
+
+import sys
+import time
+import platform
+
+from PIL import Image
+
+from waveshare_epd import epd7in5_V2
+
+# size of the frame in portrait mode
+W = 480
+H = 800
+
+
+def legacy_getbuffer(image, width=epd7in5_V2.EPD_WIDTH, height=epd7in5_V2.EPD_HEIGHT):
+    # packing of previous versions : full rotate, copy to a bytearray and xor of every byte in Python
+    img = image.rotate(90, expand=True).convert('1')
+    buf = bytearray(img.tobytes('raw'))
+    for i in range(len(buf)):
+        buf[i] ^= 0xFF
+    return buf
+
+
+def make_frame():
+    # frames are already black and white when they are packed
+    noise = Image.effect_noise((W, H), 40)
+    gradient = Image.radial_gradient("L").resize((W, H))
+    return Image.blend(gradient, noise, 0.3).convert("1")
+
+
+def measure(function, argument, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(argument)
+        timings.append(time.perf_counter() - start)
+    return min(timings), sum(timings) / len(timings)
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    display = epd7in5_V2.EPD()
+    frame = make_frame()
+    packed = display.getbuffer(frame)
+
+    if bytes(legacy_getbuffer(frame)) != bytes(packed):
+        raise SystemExit("The packed buffers differ")
+
+    cases = [
+        ("legacy loop", legacy_getbuffer, frame),
+        ("PIL image", display.getbuffer, frame),
+        ("packed bytes", display.getbuffer, memoryview(packed)),
+    ]
+
+    print(f"{platform.machine()}, Python {platform.python_version()}")
+    print(f"{'input':>14} {'best (ms)':>10} {'mean (ms)':>10}")
+    for name, function, argument in cases:
+        best, mean = measure(function, argument, repeats)
+        print(f"{name:>14} {best * 1000:>10.2f} {mean * 1000:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,24 @@
 import os
 #import sys
-import requests
-from waveshare_epd import epd7in5_V2
+import time
+import signal
+import argparse
+import threading
+from waveshare_epd import epd7in5_V2, epdconfig
 from PIL import Image
 import glob, random
 import logging
+import json
+import hashlib
 from pathlib import Path
+from io import BytesIO
 
 #import local functions
 from image_transform_local import Image_transform
+from framebuffer import decompress, FRAMEBUFFER_MIMETYPE
+from frame_diff import changed_regions, changed_area, bounding_box, window
+from fallback_library import random_frame
+from frame_fetcher import FrameFetcher
 
 # find script directory
 dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -22,60 +32,228 @@ logging.basicConfig(filename=log_file_path,
                     format='%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S',)
 
+# files keeping what the panel shows between two runs, so that only what changed is refreshed
+state_path = os.environ.get("EPD_STATE_DIR", os.path.join(dir_path, "state"))
+last_frame_path = os.path.join(state_path, "last_frame.bin")
+refresh_state_path = os.path.join(state_path, "refresh_state.json")
+
+# partial refreshes leave some ghosting : do a full refresh after this many partial ones
+FULL_REFRESH_EVERY = 10
+# above this share of the panel, a full refresh looks better than a partial one
+PARTIAL_REFRESH_MAX_AREA = 0.5
+# an unchanged frame is not refreshed, except for a full refresh after this many hours against ghosting (0 to never force it)
+FORCE_FULL_REFRESH_HOURS = float(os.environ.get("EPD_FORCE_FULL_REFRESH_HOURS", 24))
+
+#function to read the framebuffer on the panel, and what is known about it :
+#number of partial refreshes since the last full one, time of the last full refresh, hash of the framebuffer and ETag of the server's frame
+def load_refresh_state():
+    try:
+        with open(last_frame_path, "rb") as f:
+            last_frame = f.read()
+        with open(refresh_state_path, "r") as f:
+            state = json.load(f)
+        state.setdefault("partial_updates", 0)
+        return last_frame, state
+    except (OSError, ValueError, AttributeError):
+        return None, {"partial_updates": 0}
+
+#function to save the framebuffer on the panel
+def save_refresh_state(buffer, state):
+    os.makedirs(state_path, exist_ok=True)
+    with open(last_frame_path + ".tmp", "wb") as f:
+        f.write(buffer)
+    os.replace(last_frame_path + ".tmp", last_frame_path)
+    with open(refresh_state_path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(refresh_state_path + ".tmp", refresh_state_path)
+
 #function to display image
-def show_image(image):
+#image is either a PIL image or a framebuffer already packed by the server (see framebuffer.py)
+#keep_gpio leaves the pins and SPI set up after the panel goes to deep sleep, for the daemon mode
+#etag is the server's ETag of the frame, kept to make the next request conditional
+def show_image(image, keep_gpio=False, etag=None):
+    display = epd7in5_V2.EPD()
+
+    #packed framebuffers are used as they are, PIL images are rotated and packed
+    buffer = display.getbuffer(image)
+    buffer_hash = hashlib.sha256(buffer).hexdigest()
+
+    #compare with what the panel shows
+    last_frame, state = load_refresh_state()
+    full_refresh_due = FORCE_FULL_REFRESH_HOURS > 0 and time.time() - state.get("full_refresh_time", 0) >= FORCE_FULL_REFRESH_HOURS * 3600
+
+    #same frame : leave the panel asleep
+    if last_frame is not None and state.get("buffer_hash") == buffer_hash and not full_refresh_due:
+        logging.info("Frame unchanged, no refresh")
+        state["etag"] = etag
+        save_refresh_state(last_frame, state)
+        return
+
+    #a panel that timed out is not waited for again to power it off, the next init() resets it
+    panel_responding = True
     try:
         # Display init, clear
-        display = epd7in5_V2.EPD()
         display.init() #update 
-        
+
+        box = None
+        if last_frame is not None and len(last_frame) == len(buffer) and not full_refresh_due:
+            regions = changed_regions(last_frame, buffer)
+            #every partial refresh takes as long as a refresh of the panel, whatever its size :
+            #the regions are refreshed at once, in a single window around all of them
+            if regions:
+                box = bounding_box(regions)
+
+        #refresh only the window that changed
+        if box is not None and state["partial_updates"] < FULL_REFRESH_EVERY and changed_area([box]) <= PARTIAL_REFRESH_MAX_AREA:
+            logging.info(f"Partial refresh of {len(regions)} regions in the window {box}")
+            display.display_partial(window(last_frame, *box), window(buffer, *box), *box)
+            state["partial_updates"] += 1
+
         #display the image
-        display.display(display.getbuffer(image)) 
+        else:
+            logging.info("Full refresh")
+            display.display(buffer)
+            state["partial_updates"] = 0
+            state["full_refresh_time"] = time.time()
+
+        state["buffer_hash"] = buffer_hash
+        state["etag"] = etag
+        save_refresh_state(buffer, state)
+        logging.info("Panel busy periods (s): " + ", ".join(f"{duration:.2f}" for duration in display.busy_durations))
+
+    #the panel is stuck (TimeoutError is an IOError, so it is caught first)
+    except TimeoutError as e:
+        logging.error(f"The panel did not respond : {e}")
+        panel_responding = False
 
     except IOError as e:
             print(e)
 
     finally:
-        display.sleep()
-
-try:
-    logging.info("Pulling image from web")
-    # don't forget to point to the proper url view
-    filename="https://YOUR_CLOUD_RUN_WEBSITE.a.run.app/PICK_THE_RIGHT_VEW"
-
-    #pull image from web
-    response = requests.get(filename, stream=True)
-    response.raw.decode_content = True
-    image = Image.open(response.raw)
-
-    #push it to the screen
-    show_image(image)
-    
-
-#if an error occurs (connection slow or URL not accessible), print a random local picture instead
-except Exception as web_err:
-    logging.error(f"Error pulling image from web: {web_err}")
-    logging.info("Pulling image from local directory instead")
-
-    try : 
-        pic_path = os.path.join(dir_path, "pics")
-        logging.debug(f"Path to local pictures : {pic_path}")
+        if panel_responding:
+            try:
+                display.sleep(keep_gpio=keep_gpio)
+            except TimeoutError as e:
+                logging.error(f"The panel did not power off : {e}")
+                panel_responding = False
+
+        #release the pins, as sleep() does when it completes
+        if not panel_responding and not keep_gpio:
+            epdconfig.module_exit()
+
+# timeouts, retries and total time budget of the download, see frame_fetcher.py
+fetcher = FrameFetcher()
+
+#function to pull the next frame and show it, or a local picture if the server can't be reached in the fetcher's budget
+def update(keep_gpio=False):
+    try:
+        logging.info("Pulling image from web")
+        # don't forget to point to the proper url view
+        filename="https://YOUR_CLOUD_RUN_WEBSITE.a.run.app/PICK_THE_RIGHT_VEW"
+
+        #the server answers 304 Not Modified when the frame on the panel is still the current one
+        last_frame, state = load_refresh_state()
+        headers = {"Accept": FRAMEBUFFER_MIMETYPE}
+        if last_frame is not None and state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+
+        #pull the packed framebuffer from web : the server already rotated and inverted the frame, there is no image work left for the Pi
+        response = fetcher.get(filename, params={"compression": "zlib"}, headers=headers)
+
+        if response.status_code == 304:
+            logging.info("Frame not modified on the server")
+            image = last_frame
+        elif response.headers.get("Content-Type", "").startswith(FRAMEBUFFER_MIMETYPE):
+            image = decompress(response.content, response.headers.get("X-EPD-Compression", "none"))
+        else:
+            #servers that don't know the framebuffer format send a PNG
+            image = Image.open(BytesIO(response.content))
+
+        etag = response.headers.get("ETag", state.get("etag"))
+
+    #if an error occurs (connection slow or URL not accessible), print a random local picture instead
+    except Exception as web_err:
+        logging.error(f"Error pulling image from web: {web_err}")
+        logging.info("Pulling image from local directory instead")
+
+        try : 
+            #frames rendered ahead of time by fallback_library.py : nothing to decode or resize
+            buffer = random_frame()
+            if buffer is not None:
+                logging.info("Showing a frame of the fallback library")
+                show_image(buffer, keep_gpio=keep_gpio)
+                return
+
+            #no library yet : render a picture here
+            pic_path = os.path.join(dir_path, "pics")
+            logging.debug(f"Path to local pictures : {pic_path}")
         
-        file_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.JPG', '.JPEG', '.PNG', '.BMP', '.GIF'] # create a sect of file extensions
+            file_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.JPG', '.JPEG', '.PNG', '.BMP', '.GIF'] # create a sect of file extensions
         
-        all_images = [p.resolve() for p in Path(pic_path).glob("**/*") if p.suffix in file_extensions]  # Find all matching files for the given patterns in all subfolders of pic_path
+            all_images = [p.resolve() for p in Path(pic_path).glob("**/*") if p.suffix in file_extensions]  # Find all matching files for the given patterns in all subfolders of pic_path
+
+            if not all_images:
+                raise ValueError("No images found in the local directory. Check that your folder contains all your file types specified.")
+
+            #choose a random image path
+            random_image = random.choice(all_images)
+            logging.debug(f"Random image path : {random_image}")
+
+            #run the local function to process and display it
+            local_image=Image_transform(imported_image=random_image)
+            image=local_image.render(fit="crop")
+            show_image(image, keep_gpio=keep_gpio)
+
+        except Exception as err:
+            logging.error(f"The local image was not displayed : {err}")
+        return
+
+    #push it to the screen, outside of the try above : errors of the panel are not errors of the server,
+    #and showing a local picture on the same panel would not work any better
+    show_image(image, keep_gpio=keep_gpio, etag=etag)
+
+
+#function to keep updating the screen from a single process, instead of a new process per update from cron
+#updates happen at multiples of the interval (e.g. every hour on the hour), SIGTERM stops the loop after the current update
+def run_daemon(interval_minutes):
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        logging.info(f"Signal {signum} received, stopping after the current update")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    interval = interval_minutes * 60
+    logging.info(f"Display daemon started, updating every {interval_minutes} minutes")
+    try:
+        while not stop.is_set():
+            #an error in one update must not stop the daemon : the next one is tried on schedule, like with cron
+            try:
+                update(keep_gpio=True)
+            except Exception:
+                logging.exception("Update failed")
+            # sleep until the next multiple of the interval, or until a signal
+            stop.wait(interval - time.time() % interval)
+    finally:
+        #release the pins that were kept between updates
+        epdconfig.module_exit()
+        logging.info("Display daemon stopped")
+
 
-        if not all_images:
-            raise ValueError("No images found in the local directory. Check that your folder contains all your file types specified.")
+def main():
+    parser = argparse.ArgumentParser(description="Show the next picture on the e-paper screen")
+    parser.add_argument("--daemon", action="store_true", help="keep running and update the screen periodically")
+    parser.add_argument("--interval", type=float, default=float(os.environ.get("EPD_UPDATE_MINUTES", 60)),
+                        help="minutes between two updates in daemon mode (default: 60)")
+    args = parser.parse_args()
 
-        #choose a random image path
-        random_image = random.choice(all_images)
-        logging.debug(f"Random image path : {random_image}")
+    if args.daemon:
+        run_daemon(args.interval)
+    else:
+        update()
 
-        #run the local function to process and display it
-        local_image=Image_transform(imported_image=random_image)
-        image=local_image.render(fit="crop")
-        show_image(image)
 
-    except Exception as err:
-        logging.error(f"The local image was not displayed : {err}")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
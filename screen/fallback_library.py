@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Library of fallback frames, shown by display.py when the server can't be reached
+# Every picture of pics/ is rendered ahead of time into the packed framebuffer of the panel (see framebuffer.py),
+# so that the fallback only reads 48000 bytes instead of decoding and resizing a picture on the Pi.
+# Build or update it after adding pictures : python fallback_library.py [--workers N] [--force]
+# Only new or modified pictures are rendered again, the index keeps the modification time and size of each picture.
+
+import os
+import json
+import random
+import hashlib
+import argparse
+import logging
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from image_transform_local import Image_transform
+from framebuffer import to_framebuffer, FRAMEBUFFER_SIZE
+
+# find script directory
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+pics_path = os.path.join(dir_path, "pics")
+library_path = os.path.join(dir_path, "library")
+INDEX_FILE = "index.json"
+
+FILE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif'}
+
+
+def load_index(library=library_path):
+    # {picture path relative to pics/ : {"mtime", "size", "frame"}}, empty if the library was never built
+    try:
+        with open(os.path.join(library, INDEX_FILE), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(index, library=library_path):
+    path = os.path.join(library, INDEX_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def random_frame(library=library_path):
+    # framebuffer of a random picture of the library, None if it is empty
+    entries = list(load_index(library).values())
+    random.shuffle(entries)
+    for entry in entries:
+        try:
+            with open(os.path.join(library, entry["frame"]), "rb") as f:
+                buffer = f.read()
+        except OSError:
+            continue
+        if len(buffer) == FRAMEBUFFER_SIZE:
+            return buffer
+    return None
+
+
+def frame_name(relative_path):
+    # stable file name of the frame of a picture
+    return hashlib.sha1(relative_path.encode("utf-8")).hexdigest() + ".bin"
+
+
+def render_frame(picture, frame_path, fit):
+    # runs in a worker process
+    buffer = to_framebuffer(Image_transform(imported_image=picture).render(fit=fit))
+    with open(frame_path + ".tmp", "wb") as f:
+        f.write(buffer)
+    os.replace(frame_path + ".tmp", frame_path)
+
+
+def build(pics=pics_path, library=library_path, workers=None, fit="crop", force=False):
+    os.makedirs(library, exist_ok=True)
+    index = load_index(library)
+
+    pictures = {}
+    for path in Path(pics).glob("**/*"):
+        if path.is_file() and path.suffix.lower() in FILE_EXTENSIONS:
+            stat = path.stat()
+            pictures[path.relative_to(pics).as_posix()] = (str(path), stat.st_mtime, stat.st_size)
+
+    # pictures that were removed from pics/
+    for relative_path in set(index) - set(pictures):
+        entry = index.pop(relative_path)
+        try:
+            os.remove(os.path.join(library, entry["frame"]))
+        except OSError:
+            pass
+
+    # pictures that are new or changed since the last build
+    todo = []
+    for relative_path, (picture, mtime, size) in pictures.items():
+        entry = index.get(relative_path)
+        if not force and entry and entry["mtime"] == mtime and entry["size"] == size \
+                and os.path.exists(os.path.join(library, entry["frame"])):
+            continue
+        todo.append((relative_path, picture, mtime, size))
+
+    rendered = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for relative_path, picture, mtime, size in todo:
+            name = frame_name(relative_path)
+            futures[executor.submit(render_frame, picture, os.path.join(library, name), fit)] = (relative_path, mtime, size, name)
+
+        for future in as_completed(futures):
+            relative_path, mtime, size, name = futures[future]
+            try:
+                future.result()
+            except Exception as err:
+                logging.error(f"Could not render {relative_path}: {err}")
+                index.pop(relative_path, None)
+                continue
+            index[relative_path] = {"mtime": mtime, "size": size, "frame": name}
+            rendered += 1
+
+    save_index(index, library)
+    return rendered, len(index)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render the pictures of pics/ into fallback frames for display.py")
+    parser.add_argument("--pics", default=pics_path, help="folder of the pictures")
+    parser.add_argument("--library", default=library_path, help="folder of the rendered frames")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes (default: one per CPU)")
+    parser.add_argument("--fit", default="crop", choices=["crop", "width", "height"])
+    parser.add_argument("--force", action="store_true", help="render every picture again")
+    args = parser.parse_args()
+
+    rendered, total = build(args.pics, args.library, args.workers, args.fit, args.force)
+    print(f"Rendered {rendered} pictures, {total} frames in the library")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# Find the parts of the panel that changed between two framebuffers, for partial refreshes
+# The framebuffers are packed like EPD.getbuffer : 800x480 in landscape, 1 bit per pixel
+
+# resolution of the panel in its native (landscape) orientation
+EPD_WIDTH = 800
+EPD_HEIGHT = 480
+ROW_BYTES = EPD_WIDTH // 8
+
+
+def changed_regions(old_buffer, new_buffer, row_bytes=ROW_BYTES, merge_gap=16):
+    # Bounding boxes (x_start, y_start, x_end, y_end) of the changed pixels, in landscape coordinates.
+    # Changed rows closer than merge_gap rows are grouped in the same box, every box covers whole bytes horizontally.
+    height = len(new_buffer) // row_bytes
+    old_rows = memoryview(old_buffer)
+    new_rows = memoryview(new_buffer)
+
+    # [y_start, y_end, first changed byte, last changed byte]
+    boxes = []
+    for y in range(height):
+        old_row = old_rows[y * row_bytes:(y + 1) * row_bytes]
+        new_row = new_rows[y * row_bytes:(y + 1) * row_bytes]
+        # compared in C
+        if old_row == new_row:
+            continue
+
+        # the changed bytes are the non zero bytes of the xor of both rows
+        difference = int.from_bytes(old_row, 'big') ^ int.from_bytes(new_row, 'big')
+        first_byte = row_bytes - (difference.bit_length() + 7) // 8
+        last_byte = row_bytes - 1 - ((difference & -difference).bit_length() - 1) // 8
+
+        if boxes and y - boxes[-1][1] <= merge_gap:
+            box = boxes[-1]
+            box[1] = y + 1
+            box[2] = min(box[2], first_byte)
+            box[3] = max(box[3], last_byte)
+        else:
+            boxes.append([y, y + 1, first_byte, last_byte])
+
+    return [(first_byte * 8, y_start, (last_byte + 1) * 8, y_end) for y_start, y_end, first_byte, last_byte in boxes]
+
+
+def window(buffer, x_start, y_start, x_end, y_end, row_bytes=ROW_BYTES):
+    # bytes of the window, row after row, as expected by EPD.display_partial
+    view = memoryview(buffer)
+    return b''.join(view[y * row_bytes + x_start // 8:y * row_bytes + x_end // 8] for y in range(y_start, y_end))
+
+
+def bounding_box(regions):
+    # smallest window holding all the regions : they are refreshed at once, one refresh of the panel per window
+    return (min(region[0] for region in regions), min(region[1] for region in regions),
+            max(region[2] for region in regions), max(region[3] for region in regions))
+
+
+def changed_area(regions, width=EPD_WIDTH, height=EPD_HEIGHT):
+    # share of the panel covered by the regions
+    return sum((x_end - x_start) * (y_end - y_start) for x_start, y_start, x_end, y_end in regions) / (width * height)
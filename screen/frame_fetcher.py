@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Download of the frame from the server with bounded latency
+# Every attempt has connect and read timeouts, failed attempts are retried with an exponential backoff,
+# and all of it fits in a total budget : past it, display.py shows a fallback frame instead of keeping the Pi awake.
+
+import os
+import time
+import logging
+from collections import namedtuple
+
+import requests
+
+# seconds to open the connection, and to wait for each chunk of the response
+CONNECT_TIMEOUT = float(os.environ.get("EPD_CONNECT_TIMEOUT", 5))
+# a Cloud Run cold start can take some time before the first byte
+READ_TIMEOUT = float(os.environ.get("EPD_READ_TIMEOUT", 20))
+# seconds from the first request to the end of the last download, retries and backoff included
+FETCH_BUDGET = float(os.environ.get("EPD_FETCH_BUDGET", 45))
+MAX_ATTEMPTS = int(os.environ.get("EPD_FETCH_ATTEMPTS", 3))
+# wait before the first retry, doubled after every failed attempt
+BACKOFF = 1.0
+# frames are 48 KB packed and a few tens of KB as PNG : anything much bigger is not a frame
+MAX_BODY_BYTES = 4 * 1024 * 1024
+# the budget is checked after every chunk, small chunks keep a slow server from overrunning it by much
+CHUNK_SIZE = 4096
+
+# server errors worth another attempt
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# same attributes as the requests responses used before
+FetchedFrame = namedtuple("FetchedFrame", ["status_code", "headers", "content"])
+
+
+class FetchError(Exception):
+    pass
+
+
+class BudgetExceeded(FetchError):
+    pass
+
+
+# errors of the server worth another attempt
+class ServerError(FetchError):
+    pass
+
+
+class FrameFetcher:
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, budget=FETCH_BUDGET,
+                 max_attempts=MAX_ATTEMPTS, backoff=BACKOFF, max_body_bytes=MAX_BODY_BYTES):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.budget = budget
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_body_bytes = max_body_bytes
+        # kept between updates in daemon mode, so that the connection to the server can be reused
+        self.session = requests.Session()
+
+    def get(self, url, params=None, headers=None):
+        # returns a FetchedFrame, raises FetchError when every attempt failed or BudgetExceeded when time ran out.
+        # Client errors (4xx, or a body too large to be a frame) are raised at once, they won't go away with a retry.
+        start = time.monotonic()
+        deadline = start + self.budget
+        headers = dict(headers or {})
+        headers.setdefault("Accept-Encoding", "gzip, deflate")
+
+        for attempt in range(self.max_attempts):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                timeout = (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+                with self.session.get(url, params=params, headers=headers, stream=True, timeout=timeout) as response:
+                    if response.status_code in RETRY_STATUSES:
+                        raise ServerError(f"Server answered {response.status_code}")
+                    response.raise_for_status()
+                    content = self.read_body(response, deadline)
+                    logging.info(f"Frame fetched in {time.monotonic() - start:.2f} s, attempt {attempt + 1}, {len(content)} bytes")
+                    return FetchedFrame(response.status_code, response.headers, content)
+
+            except (ServerError, requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as err:
+                logging.warning(f"Attempt {attempt + 1} to fetch the frame failed: {err}")
+
+            if attempt + 1 < self.max_attempts:
+                delay = self.backoff * 2 ** attempt
+                if time.monotonic() + delay >= deadline:
+                    break
+                time.sleep(delay)
+        else:
+            raise FetchError(f"No frame after {self.max_attempts} attempts")
+
+        # no time left for another attempt
+        raise BudgetExceeded(f"No frame after {attempt + 1} attempts in {time.monotonic() - start:.1f} s, out of a budget of {self.budget:.0f} s")
+
+    def read_body(self, response, deadline):
+        # the whole body, decompressed, in a buffer of bounded size
+        body = bytearray()
+        declared_length = response.headers.get("Content-Length")
+        if declared_length and declared_length.isdigit() and int(declared_length) > self.max_body_bytes:
+            raise FetchError(f"Response of {declared_length} bytes is too large")
+
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            body += chunk
+            if len(body) > self.max_body_bytes:
+                raise FetchError(f"Response larger than {self.max_body_bytes} bytes")
+            # the read timeout is per chunk : a server sending a trickle of bytes is stopped here
+            if time.monotonic() > deadline:
+                raise BudgetExceeded("Budget exceeded while reading the frame")
+        return bytes(body)
@@ -2,11 +2,14 @@ import os
 from PIL import Image, ImageDraw, ImageFont, ImageOps
 import textwrap
 
+from dithering import dither, DEFAULT_DITHER
+
 
 #function to transform the pic pulled from gmail into a 2 tone & resized image
 class Image_transform:
-    def __init__(self, imported_image, fit="crop"):
+    def __init__(self, imported_image, fit="crop", dither_mode=DEFAULT_DITHER):
         self.imported_image=imported_image
+        self.dither_mode=dither_mode # how the shades of gray are turned into black and white pixels, see dithering.py
 
     def render(self, fit="crop"):
         # fit can be "width" or "crop" or "height"
@@ -39,7 +42,7 @@ class Image_transform:
             adjust_height=int(blank_space/2)
             
             #paste on canvas with height adjustment
-            canvas.paste(image, (0, 0+adjust_height))
+            canvas.paste(dither(image, self.dither_mode), (0, 0+adjust_height))
 
         #option 2 : fit the whole height to the frame
         if fit=="height":
@@ -53,7 +56,7 @@ class Image_transform:
             blank_space=h-image.size[1]
             adjust_height=int(blank_space/2)
             #Paste image on canvas
-            canvas.paste(image, (0, 0+adjust_height))
+            canvas.paste(dither(image, self.dither_mode), (0, 0+adjust_height))
 
         #option 3 : crop the image in the center 
         if fit=="crop":
@@ -73,7 +76,7 @@ class Image_transform:
             image = image.crop((left, top, right, bottom))
 
             #Paste image on canvas
-            canvas.paste(image, (0, 0))
+            canvas.paste(dither(image, self.dither_mode), (0, 0))
         
         return(canvas)
 
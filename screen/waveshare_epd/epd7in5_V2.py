@@ -28,13 +28,23 @@
 #
 
 
+import time
 import logging
+from collections import deque
+from PIL import Image
 from . import epdconfig
 
 # Display resolution
 EPD_WIDTH       = 800
 EPD_HEIGHT      = 480
 
+# inverts every bit of a byte, see getbuffer
+INVERT_TABLE = bytes(255 - value for value in range(256))
+
+# longest sleep between two checks of the BUSY pin while waiting for an edge,
+# in case the edge happened between the read of the pin and the start of the wait
+BUSY_EDGE_SLICE_MS = 200
+
 logger = logging.getLogger(__name__)
 
 class EPD:
@@ -45,6 +55,10 @@ class EPD:
         self.cs_pin = epdconfig.CS_PIN
         self.width = EPD_WIDTH
         self.height = EPD_HEIGHT
+        self.buffer_size = EPD_WIDTH // 8 * EPD_HEIGHT
+        # how long the last busy periods lasted, in seconds
+        self.busy_durations = deque(maxlen=100)
+        self.edge_detection = True
     
     Voltage_Frame_7IN5_V2 = [
 	0x6, 0x3F, 0x3F, 0x11, 0x24, 0x7, 0x17,
@@ -100,6 +114,33 @@ class EPD:
         0x0,	0x0,	0x0,	0x0,	0x0,	0x0,	
     ]
 
+    # Init sequence, as (command, data) pairs sent in one transfer each.
+    # POWER_SEQUENCE is sent before POWER ON, PANEL_SEQUENCE once the booster is up.
+    POWER_SEQUENCE = (
+        (0x01, bytes([0x17,     # power setting, 1-0=11: internal power
+            Voltage_Frame_7IN5_V2[6],   # VGH&VGL
+            Voltage_Frame_7IN5_V2[1],   # VSH
+            Voltage_Frame_7IN5_V2[2],   # VSL
+            Voltage_Frame_7IN5_V2[3]])),    # VSHR
+        (0x82, bytes([Voltage_Frame_7IN5_V2[4]])),     # VCOM DC Setting
+        (0x06, bytes([0x27, 0x27, 0x2F, 0x17])),       # Booster Setting
+        (0x30, bytes([Voltage_Frame_7IN5_V2[0]])),     # OSC Setting, 2-0=100: N=4  ; 5-3=111: M=7  ;  3C=50Hz     3A=100HZ
+    )
+
+    PANEL_SEQUENCE = (
+        (0x00, bytes([0x3F])),      # PANNEL SETTING, KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
+        (0x61, bytes([0x03, 0x20, 0x01, 0xE0])),    # tres, source 800, gate 480
+        (0x15, bytes([0x00])),
+        (0x50, bytes([0x10, 0x07])),    # VCOM AND DATA INTERVAL SETTING
+        (0x60, bytes([0x22])),      # TCON SETTING
+        (0x65, bytes([0x00, 0x00, 0x00, 0x00])),    # Resolution setting, 800*480
+        (0x20, bytes(LUT_VCOM_7IN5_V2)),
+        (0x21, bytes(LUT_WW_7IN5_V2)),
+        (0x22, bytes(LUT_BW_7IN5_V2)),
+        (0x23, bytes(LUT_WB_7IN5_V2)),
+        (0x24, bytes(LUT_BB_7IN5_V2)),
+    )
+
     # Hardware reset
     def reset(self):
         epdconfig.digital_write(self.reset_pin, 1)
@@ -124,39 +165,62 @@ class EPD:
     def send_data2(self, data):
         epdconfig.digital_write(self.dc_pin, 1)
         epdconfig.digital_write(self.cs_pin, 0)
-        epdconfig.SPI.writebytes2(data)
+        epdconfig.spi_writebyte2(data)
+        epdconfig.digital_write(self.cs_pin, 1)
+
+    # command followed by its whole payload, in a single chip select
+    def send_command_data(self, command, data):
+        epdconfig.digital_write(self.dc_pin, 0)
+        epdconfig.digital_write(self.cs_pin, 0)
+        epdconfig.spi_writebyte([command])
+        epdconfig.digital_write(self.dc_pin, 1)
+        epdconfig.spi_writebyte2(data)
         epdconfig.digital_write(self.cs_pin, 1)
 
-    def ReadBusy(self):
+    def send_sequence(self, sequence):
+        for command, data in sequence:
+            self.send_command_data(command, data)
+
+    # Wait for the BUSY pin to go high. The CPU sleeps until the rising edge, or between reads of the pin
+    # when edge detection is not available. Raises TimeoutError if the panel stays busy longer than timeout_ms.
+    def ReadBusy(self, timeout_ms=None):
         logger.debug("e-Paper busy")
+        if timeout_ms is None:
+            timeout_ms = epdconfig.BUSY_TIMEOUT_MS
+        start = time.monotonic()
+        deadline = start + timeout_ms / 1000.0
+
         self.send_command(0x71)
         busy = epdconfig.digital_read(self.busy_pin)
         while(busy == 0):
+            remaining_ms = (deadline - time.monotonic()) * 1000
+            if remaining_ms <= 0:
+                self.busy_durations.append(time.monotonic() - start)
+                raise TimeoutError("e-Paper still busy after " + str(timeout_ms) + " ms")
+
+            if self.edge_detection:
+                try:
+                    epdconfig.wait_for_edge(self.busy_pin, min(remaining_ms, BUSY_EDGE_SLICE_MS))
+                except RuntimeError as e:
+                    logger.warning("Edge detection unavailable, polling the BUSY pin instead: " + str(e))
+                    self.edge_detection = False
+            else:
+                epdconfig.delay_ms(min(remaining_ms, epdconfig.BUSY_POLL_MS))
+
             self.send_command(0x71)
             busy = epdconfig.digital_read(self.busy_pin)
+
+        duration = time.monotonic() - start
+        self.busy_durations.append(duration)
         epdconfig.delay_ms(20)
-        logger.debug("e-Paper busy release")
+        logger.debug("e-Paper busy release after %.3f s", duration)
         
     def SetLut(self, lut_vcom, lut_ww, lut_bw, lut_wb, lut_bb):
-        self.send_command(0x20)
-        for count in range(0, 42):
-            self.send_data(lut_vcom[count])
-
-        self.send_command(0x21)
-        for count in range(0, 42):
-            self.send_data(lut_ww[count])
-
-        self.send_command(0x22)
-        for count in range(0, 42):
-            self.send_data(lut_bw[count])
-
-        self.send_command(0x23)
-        for count in range(0, 42):
-            self.send_data(lut_wb[count])
-
-        self.send_command(0x24)
-        for count in range(0, 42):
-            self.send_data(lut_bb[count])
+        self.send_command_data(0x20, bytes(lut_vcom[:42]))
+        self.send_command_data(0x21, bytes(lut_ww[:42]))
+        self.send_command_data(0x22, bytes(lut_bw[:42]))
+        self.send_command_data(0x23, bytes(lut_wb[:42]))
+        self.send_command_data(0x24, bytes(lut_bb[:42]))
 
     def init(self):
         if (epdconfig.module_init() != 0):
@@ -176,103 +240,87 @@ class EPD:
         # self.send_data(0x3f)		#VDH=15V
         # self.send_data(0x3f)		#VDL=-15V
 
-        self.send_command(0x01);  # power setting
-        self.send_data(0x17);  # 1-0=11: internal power
-        self.send_data(self.Voltage_Frame_7IN5_V2[6]);  # VGH&VGL
-        self.send_data(self.Voltage_Frame_7IN5_V2[1]);  # VSH
-        self.send_data(self.Voltage_Frame_7IN5_V2[2]);  #  VSL
-        self.send_data(self.Voltage_Frame_7IN5_V2[3]);  #  VSHR
-        
-        self.send_command(0x82); # VCOM DC Setting
-        self.send_data(self.Voltage_Frame_7IN5_V2[4]);  # VCOM
-
-        self.send_command(0x06);  # Booster Setting
-        self.send_data(0x27);
-        self.send_data(0x27);
-        self.send_data(0x2F);
-        self.send_data(0x17);
-        
-        self.send_command(0x30);   # OSC Setting
-        self.send_data(self.Voltage_Frame_7IN5_V2[0]);  # 2-0=100: N=4  ; 5-3=111: M=7  ;  3C=50Hz     3A=100HZ
+        self.send_sequence(self.POWER_SEQUENCE)
 
         self.send_command(0x04) #POWER ON
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
-        self.send_command(0X00)			#PANNEL SETTING
-        self.send_data(0x3F)   #KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
-
-        self.send_command(0x61)        	#tres
-        self.send_data(0x03)		#source 800
-        self.send_data(0x20)
-        self.send_data(0x01)		#gate 480
-        self.send_data(0xE0)
-
-        self.send_command(0X15)
-        self.send_data(0x00)
-
-        self.send_command(0X50)			#VCOM AND DATA INTERVAL SETTING
-        self.send_data(0x10)
-        self.send_data(0x07)
-
-        self.send_command(0X60)			#TCON SETTING
-        self.send_data(0x22)
-
-        self.send_command(0x65);  # Resolution setting
-        self.send_data(0x00);
-        self.send_data(0x00); # 800*480
-        self.send_data(0x00);
-        self.send_data(0x00);
-
-        self.SetLut(self.LUT_VCOM_7IN5_V2, self.LUT_WW_7IN5_V2, self.LUT_BW_7IN5_V2, self.LUT_WB_7IN5_V2, self.LUT_BB_7IN5_V2)
+        # panel settings and LUTs
+        self.send_sequence(self.PANEL_SEQUENCE)
         # EPD hardware init end
         return 0
 
     def getbuffer(self, image):
-        img = image
-        imwidth, imheight = img.size
+        # image is a PIL image, or a framebuffer already packed by the server (bytes, bytearray or memoryview).
+        # Returns a buffer that can be handed to send_data2 as is.
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            if len(image) != self.buffer_size:
+                logger.warning("Wrong framebuffer size: must be " + str(self.buffer_size) + " bytes")
+                return bytes(self.buffer_size)
+            return image
+
+        imwidth, imheight = image.size
         if(imwidth == self.width and imheight == self.height):
-            img = img.convert('1')
+            img = image.convert('1')
         elif(imwidth == self.height and imheight == self.width):
             # image has correct dimensions, but needs to be rotated
-            img = img.rotate(90, expand=True).convert('1')
+            img = image.transpose(Image.ROTATE_90).convert('1')
         else:
             logger.warning("Wrong image dimensions: must be " + str(self.width) + "x" + str(self.height))
             # return a blank buffer
-            return [0x00] * (int(self.width/8) * self.height)
+            return bytes(self.buffer_size)
 
-        buf = bytearray(img.tobytes('raw'))
         # The bytes need to be inverted, because in the PIL world 0=black and 1=white, but
         # in the e-paper world 0=white and 1=black.
-        for i in range(len(buf)):
-            buf[i] ^= 0xFF
-        return buf
+        return img.tobytes('raw').translate(INVERT_TABLE)
 
     def display(self, image):
-        self.send_command(0x13)
-        self.send_data2(image)
+        self.send_command_data(0x13, image)
 
         self.send_command(0x12)
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
+    def display_partial(self, old_image, image, x_start, y_start, x_end, y_end):
+        # Refresh only the window [x_start, x_end) x [y_start, y_end) of the panel (landscape coordinates).
+        # x_start and x_end must be multiples of 8. old_image and image hold the bytes of the window only,
+        # row after row : what the panel currently shows, and what it should show.
+        self.send_command_data(0x50, bytes([0xA9, 0x07]))     # VCOM AND DATA INTERVAL SETTING for partial updates
+
+        self.send_command(0x91)     # enter partial mode
+        # partial window, the last byte makes the gates scan both inside and outside of the window
+        self.send_command_data(0x90, bytes([x_start // 256, x_start % 256, (x_end - 1) // 256, (x_end - 1) % 256,
+                                            y_start // 256, y_start % 256, (y_end - 1) // 256, (y_end - 1) % 256, 0x01]))
+
+        self.send_command_data(0x10, old_image)     # old data
+        self.send_command_data(0x13, image)     # new data
+
+        self.send_command(0x12)
+        epdconfig.delay_ms(100)
+        self.ReadBusy()
+
+        self.send_command(0x92)     # exit partial mode
+        self.send_command_data(0x50, bytes([0x10, 0x07]))     # back to the setting of init()
+
     def Clear(self):
-        buf = [0x00] * (int(self.width/8) * self.height)
-        self.send_command(0x10)
-        self.send_data2(buf)
-        self.send_command(0x13)
-        self.send_data2(buf)
+        buf = bytes(self.buffer_size)
+        self.send_command_data(0x10, buf)
+        self.send_command_data(0x13, buf)
         self.send_command(0x12)
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
-    def sleep(self):
+    # Power off and deep sleep. With keep_gpio, the pins and SPI stay set up for the next init(),
+    # which wakes the panel with a hardware reset.
+    def sleep(self, keep_gpio=False):
         self.send_command(0x02) # POWER_OFF
         self.ReadBusy()
         
-        self.send_command(0x07) # DEEP_SLEEP
-        self.send_data(0XA5)
+        self.send_command_data(0x07, bytes([0xA5])) # DEEP_SLEEP
         
+        if keep_gpio:
+            return
         epdconfig.delay_ms(2000)
         epdconfig.module_exit()
 ### END OF FILE ###
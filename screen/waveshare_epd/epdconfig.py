@@ -34,6 +34,16 @@ import time
 
 logger = logging.getLogger(__name__)
 
+# SPI clock, the panel controller accepts up to 20 MHz but long wires may need less
+SPI_SPEED_HZ = int(os.environ.get("EPD_SPI_SPEED_HZ", 4000000))
+# largest transfer handed to the SPI driver at once, spidev refuses more than its bufsiz (4096 bytes by default)
+SPI_CHUNK_SIZE = int(os.environ.get("EPD_SPI_CHUNK_SIZE", 4096))
+
+# longest time the panel may stay busy before it is considered hung, a full refresh takes about 4 s but more in the cold
+BUSY_TIMEOUT_MS = int(os.environ.get("EPD_BUSY_TIMEOUT_MS", 60000))
+# sleep between two reads of the BUSY pin when edge detection is not available
+BUSY_POLL_MS = int(os.environ.get("EPD_BUSY_POLL_MS", 10))
+
 
 class RaspberryPi:
     # Pin definition
@@ -48,6 +58,7 @@ class RaspberryPi:
 
         self.GPIO = RPi.GPIO
         self.SPI = spidev.SpiDev()
+        self.initialized = False
 
     def digital_write(self, pin, value):
         self.GPIO.output(pin, value)
@@ -58,13 +69,23 @@ class RaspberryPi:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_for_edge(self, pin, timeout_ms):
+        # sleep until the pin goes high or the timeout expires, raises RuntimeError when edge detection is unavailable
+        return self.GPIO.wait_for_edge(pin, self.GPIO.RISING, timeout=max(1, int(timeout_ms))) is not None
+
     def spi_writebyte(self, data):
         self.SPI.writebytes(data)
 
     def spi_writebyte2(self, data):
-        self.SPI.writebytes2(data)
+        # writebytes2 takes any buffer : slices of a memoryview are sent without copies
+        data = memoryview(data) if isinstance(data, (bytes, bytearray, memoryview)) else memoryview(bytes(data))
+        for start in range(0, len(data), SPI_CHUNK_SIZE):
+            self.SPI.writebytes2(data[start:start + SPI_CHUNK_SIZE])
 
     def module_init(self):
+        # nothing to do when the pins and SPI are still set up from a previous update
+        if self.initialized:
+            return 0
         self.GPIO.setmode(self.GPIO.BCM)
         self.GPIO.setwarnings(False)
         self.GPIO.setup(self.RST_PIN, self.GPIO.OUT)
@@ -74,8 +95,9 @@ class RaspberryPi:
 
         # SPI device, bus = 0, device = 0
         self.SPI.open(0, 0)
-        self.SPI.max_speed_hz = 4000000
+        self.SPI.max_speed_hz = SPI_SPEED_HZ
         self.SPI.mode = 0b00
+        self.initialized = True
         return 0
 
     def module_exit(self):
@@ -87,6 +109,7 @@ class RaspberryPi:
         self.GPIO.output(self.DC_PIN, 0)
 
         self.GPIO.cleanup()
+        self.initialized = False
 
 
 class JetsonNano:
@@ -114,6 +137,7 @@ class JetsonNano:
 
         import Jetson.GPIO
         self.GPIO = Jetson.GPIO
+        self.initialized = False
 
     def digital_write(self, pin, value):
         self.GPIO.output(pin, value)
@@ -124,10 +148,22 @@ class JetsonNano:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_for_edge(self, pin, timeout_ms):
+        # sleep until the pin goes high or the timeout expires, raises RuntimeError when edge detection is unavailable
+        return self.GPIO.wait_for_edge(pin, self.GPIO.RISING, timeout=max(1, int(timeout_ms))) is not None
+
     def spi_writebyte(self, data):
         self.SPI.SYSFS_software_spi_transfer(data[0])
 
+    def spi_writebyte2(self, data):
+        # the software SPI only sends one byte at a time
+        for byte in bytes(data):
+            self.SPI.SYSFS_software_spi_transfer(byte)
+
     def module_init(self):
+        # nothing to do when the pins and SPI are still set up from a previous update
+        if self.initialized:
+            return 0
         self.GPIO.setmode(self.GPIO.BCM)
         self.GPIO.setwarnings(False)
         self.GPIO.setup(self.RST_PIN, self.GPIO.OUT)
@@ -135,6 +171,7 @@ class JetsonNano:
         self.GPIO.setup(self.CS_PIN, self.GPIO.OUT)
         self.GPIO.setup(self.BUSY_PIN, self.GPIO.IN)
         self.SPI.SYSFS_software_spi_begin()
+        self.initialized = True
         return 0
 
     def module_exit(self):
@@ -146,9 +183,152 @@ class JetsonNano:
         self.GPIO.output(self.DC_PIN, 0)
 
         self.GPIO.cleanup()
+        self.initialized = False
+
+
+class Simulated:
+    # Panel without hardware, for development and benchmarks on any machine : select it with EPD_BACKEND=simulated.
+    # Records the SPI transfers and GPIO writes, keeps the controller memory and makes BUSY low for as long as the panel would be busy.
+    # Pin definition
+    RST_PIN         = 17
+    DC_PIN          = 25
+    CS_PIN          = 8
+    BUSY_PIN        = 24
+
+    # resolution of the panel in its native (landscape) orientation
+    WIDTH           = 800
+    HEIGHT          = 480
+
+    # how long the panel stays busy after these commands, in ms : power on, refresh, power off
+    BUSY_MS = {0x04: 80, 0x12: 3900, 0x02: 30}
+    PARTIAL_REFRESH_MS = 1800
+
+    def __init__(self):
+        # real time spent per simulated ms, 0 makes the panel instant but still counts the simulated time
+        self.time_scale = float(os.environ.get("EPD_SIM_TIME_SCALE", 1.0))
+        self.row_bytes = self.WIDTH // 8
+        self.reset_log()
+
+        self.pins = {self.RST_PIN: 0, self.DC_PIN: 0, self.CS_PIN: 1}
+        self.busy_until = 0
+        self.command = None
+        self.position = 0
+        self.partial = False
+        self.window = (0, 0, self.WIDTH, self.HEIGHT)
+        self.window_data = bytearray()
+        # controller memory (0x10 old data, 0x13 new data), and what the panel shows
+        self.old_ram = bytearray(self.row_bytes * self.HEIGHT)
+        self.new_ram = bytearray(self.row_bytes * self.HEIGHT)
+        self.screen = bytearray(self.row_bytes * self.HEIGHT)
+
+    def reset_log(self):
+        # (dc, bytes) of every SPI transfer, (time, pin, value) of every GPIO write
+        self.transfers = []
+        self.gpio = []
+        self.commands = []
+        self.refreshes = 0
+        self.simulated_ms = 0
+
+    def _sleep(self, delaytime):
+        self.simulated_ms += delaytime
+        if self.time_scale > 0:
+            time.sleep(delaytime * self.time_scale / 1000.0)
+
+    def _set_busy(self, delaytime):
+        self.simulated_ms += delaytime
+        self.busy_until = time.monotonic() + delaytime * self.time_scale / 1000.0
+
+    def digital_write(self, pin, value):
+        self.gpio.append((time.monotonic(), pin, value))
+        self.pins[pin] = value
+
+    def digital_read(self, pin):
+        if pin == self.BUSY_PIN:
+            return 0 if time.monotonic() < self.busy_until else 1
+        return self.pins.get(pin, 0)
+
+    def delay_ms(self, delaytime):
+        self._sleep(delaytime)
+
+    def wait_for_edge(self, pin, timeout_ms):
+        remaining = self.busy_until - time.monotonic()
+        time.sleep(max(0, min(remaining, timeout_ms / 1000.0)))
+        return time.monotonic() >= self.busy_until
+
+    def spi_writebyte(self, data):
+        self._transfer(bytes(data))
+
+    def spi_writebyte2(self, data):
+        self._transfer(bytes(data))
+
+    def _transfer(self, data):
+        if self.pins[self.CS_PIN] != 0:
+            raise RuntimeError("SPI transfer without chip select")
+        self.transfers.append((self.pins[self.DC_PIN], data))
+        if self.pins[self.DC_PIN] == 0:
+            for command in data:
+                self._command(command)
+        else:
+            self._data(data)
+
+    def _command(self, command):
+        self.commands.append(command)
+        self.command = command
+        self.position = 0
+        if command == 0x90:
+            self.window_data = bytearray()
+        elif command == 0x91:
+            self.partial = True
+        elif command == 0x92:
+            self.partial = False
+            self.window = (0, 0, self.WIDTH, self.HEIGHT)
+        elif command == 0x12:
+            self.screen[:] = self.new_ram
+            self.refreshes += 1
+            self._set_busy(self.PARTIAL_REFRESH_MS if self.partial else self.BUSY_MS[0x12])
+        elif command in self.BUSY_MS:
+            self._set_busy(self.BUSY_MS[command])
+
+    def _data(self, data):
+        if self.command == 0x90:
+            self.window_data += data
+            if len(self.window_data) >= 8:
+                values = self.window_data
+                self.window = (values[0] * 256 + values[1], values[4] * 256 + values[5],
+                               values[2] * 256 + values[3] + 1, values[6] * 256 + values[7] + 1)
+        elif self.command in (0x10, 0x13):
+            ram = self.old_ram if self.command == 0x10 else self.new_ram
+            x_start, y_start, x_end, y_end = self.window if self.partial else (0, 0, self.WIDTH, self.HEIGHT)
+            window_row_bytes = (x_end - x_start) // 8
+            # the data fills the window row after row, and may come in chunks that don't start at a row
+            offset = 0
+            while offset < len(data):
+                row, column = divmod(self.position + offset, window_row_bytes)
+                if row >= y_end - y_start:
+                    break
+                start = (y_start + row) * self.row_bytes + x_start // 8 + column
+                length = min(window_row_bytes - column, len(data) - offset)
+                ram[start:start + length] = data[offset:offset + length]
+                offset += length
+            self.position += len(data)
+
+    def image(self):
+        # what the panel shows, as a landscape PIL image : 1 is black in the panel memory but white in PIL
+        from PIL import Image
+        invert = bytes(255 - value for value in range(256))
+        return Image.frombytes("1", (self.WIDTH, self.HEIGHT), bytes(self.screen).translate(invert))
+
+    def module_init(self):
+        self.gpio.append((time.monotonic(), "init", None))
+        return 0
+
+    def module_exit(self):
+        self.gpio.append((time.monotonic(), "exit", None))
 
 
-if os.path.exists('/sys/bus/platform/drivers/gpiomem-bcm2835'):
+if os.environ.get("EPD_BACKEND") == "simulated":
+    implementation = Simulated()
+elif os.path.exists('/sys/bus/platform/drivers/gpiomem-bcm2835'):
     implementation = RaspberryPi()
 else:
     implementation = JetsonNano()
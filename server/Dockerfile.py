@@ -32,4 +32,7 @@ ENV PORT 8080
 # server, with one worker process and 8 threads. For environments 
 # with multiple CPU cores, increase the number of workers to match 
 # the number of cores available.
-CMD exec gunicorn --bind 0.0.0.0:$PORT --workers 1 --threads 8 --timeout 0 main:app
\ No newline at end of file
+CMD exec gunicorn --bind 0.0.0.0:$PORT --workers 1 --threads 8 --timeout 0 main:app
+
+# Async serving mode : the same routes on one event loop, with concurrent Gmail calls (see async_app.py)
+# CMD exec hypercorn --bind 0.0.0.0:$PORT async_app:app
\ No newline at end of file
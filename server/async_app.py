@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+# Async serving mode of the DispatchPi app : the routes of main.py on an ASGI server
+# The Gmail calls don't block the event loop (see async_gmail.py) and the images are rendered in worker threads,
+# so that one instance serves many frames at once instead of one per gunicorn thread.
+# Run it with : hypercorn async_app:app --bind 0.0.0.0:$PORT
+
+import os
+import asyncio
+import hashlib
+from io import BytesIO
+
+import httpx
+import quart
+from PIL import Image
+from hypercorn.middleware import ProxyFixMiddleware
+
+#google libraries
+import google_auth_oauthlib.flow
+
+#the configuration, credentials, queues and caches are the ones of the flask app
+import main
+from main import credential_manager, frame_cache, queue_store, render_frame, generate_credentials
+from main import CLIENT_SECRETS_FILE, SCOPES, FRAMES, INGEST_INTERVAL
+from dithering import DITHER_MODES
+from framebuffer import to_framebuffer, compress, COMPRESSIONS, FRAMEBUFFER_MIMETYPE
+from frame_cache import FrameCache
+from async_gmail import AsyncGmailConnector
+
+#created in the event loop of the server, see get_gmail_inbox and start_ingest
+gmail_inbox = None
+gmail_inbox_lock = None
+ingest_task = None
+#set once the inbox was scanned since the app started
+inbox_synced = False
+
+##QUART APP
+app = quart.Quart(__name__)
+app.secret_key = main.app.secret_key
+
+
+def get_gmail_inbox(creds):
+  global gmail_inbox
+
+  # initialize connector
+  if gmail_inbox is None:
+    gmail_inbox = AsyncGmailConnector(creds=creds, frames = FRAMES, incremental = True, render_frame = render_frame, queue_store = queue_store)
+
+  # use the latest credentials, refreshed in the background by the credential manager
+  gmail_inbox.creds = creds
+  return gmail_inbox
+
+async def ingest(creds, render_frames=True, only_once=False):
+  # pull the new emails of all the frames, in one scan of the inbox
+  # with only_once, nothing is pulled if the inbox was already scanned since the app started
+  global inbox_synced
+  async with gmail_inbox_lock:
+    gmail_inbox = get_gmail_inbox(creds)
+    if not (only_once and inbox_synced):
+      await gmail_inbox.pull_attachments_async()
+      inbox_synced = True
+
+  # render the new images in worker threads
+  if render_frames:
+    for target in FRAMES:
+      await gmail_inbox.render_pending_frames_async(target)
+
+async def ingest_loop():
+  # keep the queues and their frames up to date, away from the requests of the frames
+  while True:
+    credentials = await asyncio.to_thread(generate_credentials)
+    if credentials is not None:
+      try:
+        await ingest(credentials)
+      except Exception as e:
+        print(f"Error in ingest_loop: {e}")
+    await asyncio.sleep(INGEST_INTERVAL)
+
+@app.before_serving
+async def start_ingest():
+  global gmail_inbox_lock, ingest_task
+  gmail_inbox_lock = asyncio.Lock()
+  ingest_task = asyncio.create_task(ingest_loop())
+
+@app.after_serving
+async def stop_ingest():
+  ingest_task.cancel()
+  if gmail_inbox is not None:
+    await gmail_inbox.aclose()
+
+async def pull_and_display_image(frame_config, creds, fit=None, dither_mode=None):
+  target = frame_config.name
+  fit = fit or frame_config.fit
+  dither_mode = dither_mode or frame_config.dither
+
+  # after a restart, sync once before answering
+  if not inbox_synced:
+    await ingest(creds, render_frames=False, only_once=True)
+
+  gmail_inbox = get_gmail_inbox(creds)
+
+  # find the queue entry to display today
+  image_entry = await asyncio.to_thread(gmail_inbox.get_image_to_display, target)
+
+  # nothing was received yet
+  if image_entry is None:
+    return None
+
+  # the rendered frame only depends on the entry, the day and the layout, so reuse it if it was already computed
+  cache_key = FrameCache.make_key(target, image_entry.unique_attachment_id, image_entry.display_date, fit, image_entry.text, dither_mode)
+  frame = await asyncio.to_thread(frame_cache.get, cache_key)
+
+  # otherwise use the frame rendered at ingest time
+  if frame is None and fit == frame_config.fit and dither_mode == frame_config.dither:
+    frame = await asyncio.to_thread(gmail_inbox.load_frame, target, image_entry)
+    if frame is not None:
+      frame_cache.put(cache_key, frame, persist=False)
+
+  # otherwise render it now, in a worker thread
+  if frame is None:
+    image_to_send = await gmail_inbox.pull_specific_image_async(image_entry.temporary_attachment_id, image_entry.message_id, image_entry.unique_attachment_id)
+    frame = await asyncio.to_thread(render_frame, image_to_send, image_entry.text, frame_config, fit, dither_mode)
+    await asyncio.to_thread(frame_cache.put, cache_key, frame)
+
+  return frame
+
+
+async def send_frame(frame):
+  # same formats as send_frame in main.py : PNG, or the packed framebuffer of the panel
+  if quart.request.args.get('format') != 'epd' and FRAMEBUFFER_MIMETYPE not in quart.request.headers.get('Accept', ''):
+    return conditional_response(frame, "image/png")
+
+  # optional compression : ?compression=zlib or ?compression=rle
+  compression = quart.request.args.get('compression', 'none')
+  if compression not in COMPRESSIONS:
+    return (f'Unknown compression. Use one of {", ".join(COMPRESSIONS)}.', 400)
+
+  body = await asyncio.to_thread(lambda: compress(to_framebuffer(Image.open(BytesIO(frame))), compression))
+  response = conditional_response(body, FRAMEBUFFER_MIMETYPE)
+  response.headers['X-EPD-Compression'] = compression
+  return response
+
+
+def conditional_response(body, mimetype):
+  # the ETag is a hash of the body : a client sending it back in If-None-Match gets an empty 304 until the frame changes
+  etag = hashlib.sha256(body).hexdigest()[:32]
+  if etag in quart.request.if_none_match:
+    response = quart.Response(b"", status=304)
+  else:
+    response = quart.Response(body, mimetype=mimetype)
+  response.headers['Cache-Control'] = 'no-cache'
+  response.set_etag(etag)
+  return response
+
+
+# define the index
+@app.route('/')
+async def index():
+  return main.index()
+
+# define view for any frame of frames.json
+@app.route('/frame/<name>')
+async def api_route_frame(name):
+  #unknown frames get a 404, before asking for credentials
+  if name not in FRAMES:
+    return (f'Unknown frame. Use one of {", ".join(FRAMES)}.', 404)
+
+  #get the credentials if we have a token file
+  credentials = await asyncio.to_thread(generate_credentials)
+
+  #if there are no credentials, redirect to the authorization flow
+  if credentials is None:
+    #create a session parameter to send the user to the right view after the auth flow
+    quart.session['view'] = name
+    return quart.redirect(quart.url_for('authorize'))
+
+  #the dithering can be picked with ?dither=atkinson (see dithering.py)
+  dither_mode = quart.request.args.get('dither', FRAMES[name].dither)
+  if dither_mode not in DITHER_MODES:
+    return (f'Unknown dithering mode. Use one of {", ".join(DITHER_MODES)}.', 400)
+
+  #pull and display image
+  frame = await pull_and_display_image(frame_config = FRAMES[name], creds = credentials, dither_mode = dither_mode)
+  if frame is None:
+    return ('No image received yet.', 404)
+  return await send_frame(frame)
+
+# the routes of the first two frames, still used by the screens set up before /frame/<name>
+@app.route('/satellite_frame')
+async def api_route_satellite_frame():
+  return await api_route_frame("satellite_frame")
+
+@app.route('/earth_frame')
+async def api_route_earth_frame():
+  return await api_route_frame("earth_frame")
+
+
+# build the authorization flow
+@app.route('/authorize')
+async def authorize():
+
+  #if testing the auth flow directly, send to the index
+  if 'view' not in quart.session:
+    quart.session['view'] = "index"
+
+  #if the credentials are already there, send to the index
+  if await asyncio.to_thread(generate_credentials) is not None:
+    return quart.redirect(quart.url_for('index'))
+
+  # Create flow instance to manage the OAuth 2.0 Authorization Grant Flow steps.
+  flow = google_auth_oauthlib.flow.Flow.from_client_secrets_file(CLIENT_SECRETS_FILE, scopes=SCOPES)
+  # The URI created here must exactly match one of the authorized redirect URIs of the OAuth 2.0 client
+  flow.redirect_uri = quart.url_for('oauth2callback', _external=True)
+
+  authorization_url, state = flow.authorization_url(access_type='offline', include_granted_scopes='false')
+
+  # Store the state so the callback can verify the auth server response.
+  quart.session['state'] = state
+
+  return quart.redirect(authorization_url)
+
+# define the callback
+@app.route('/oauth2callback')
+async def oauth2callback():
+  # Specify the state when creating the flow in the callback so that it can verified in the authorization server response.
+  state = quart.session['state']
+
+  flow = google_auth_oauthlib.flow.Flow.from_client_secrets_file(CLIENT_SECRETS_FILE, scopes=SCOPES, state=state)
+  flow.redirect_uri = quart.url_for('oauth2callback', _external=True)
+
+  # Use the authorization server's response to fetch the OAuth 2.0 tokens, without blocking the other requests
+  await asyncio.to_thread(flow.fetch_token, authorization_response=quart.request.url)
+
+  #save the credentials to file, in a worker thread like the other storage writes
+  await asyncio.to_thread(credential_manager.set_credentials, flow.credentials)
+
+  return quart.redirect(quart.url_for('index'))
+
+#revoke the credentials : remove the app from authorized apps
+#this will reset the refresh token, you'll have to erase the token file to start over
+@app.route('/revoke')
+async def revoke():
+
+  credentials = await asyncio.to_thread(generate_credentials)
+
+  async with httpx.AsyncClient() as client:
+    revoke = await client.post('https://oauth2.googleapis.com/revoke',
+        params={'token': credentials.token},
+        headers = {'content-type': 'application/x-www-form-urlencoded'})
+
+  if revoke.status_code == 200:
+    #the revoked credentials are no longer kept in memory
+    credential_manager.clear()
+    return('Credentials successfully revoked.' + main.index())
+
+  else:
+    return('An error occurred.' + main.index())
+
+
+if __name__ == '__main__':
+  # When running locally, disable OAuthlib's HTTPs verification.
+  # When running in production *do not* leave this option enabled.
+  os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+  app.run('localhost', 8080, debug=True)
+
+else:
+  # When running online, use the scheme of the proxy (https) for the URLs
+  app.asgi_app = ProxyFixMiddleware(app.asgi_app, mode="legacy", trusted_hops=1)
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Gmail connector for the async serving mode (async_app.py)
+# The Gmail REST API is called with httpx without blocking the event loop, and the messages of a sync are fetched
+# concurrently with asyncio.gather. The queues, frames and attachments are handled by GmailConnector,
+# their SQLite and disk operations run in worker threads so that they don't block the event loop either.
+
+import io
+import base64
+import asyncio
+
+import httpx
+from PIL import Image
+
+from gmail_connector import GmailConnector, METADATA_FIELDS, FULL_FIELDS, BATCH_RETRIES, BATCH_RETRY_DELAY, MAX_SCAN
+from frame_registry import search_filter
+
+GMAIL_API = "https://gmail.googleapis.com/gmail/v1/users/me/"
+# requests in flight at once : Gmail allows 250 quota units per user and per second, a messages.get costs 5
+MAX_CONCURRENT_REQUESTS = 10
+TIMEOUT = 30
+
+
+class AsyncGmailConnector(GmailConnector):
+    # create it from a coroutine : the HTTP client and the semaphore belong to the running event loop
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.http_client = httpx.AsyncClient(base_url=GMAIL_API, timeout=TIMEOUT,
+                                             limits=httpx.Limits(max_connections=MAX_CONCURRENT_REQUESTS))
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def api_get(self, path : str, **params):
+        async with self.semaphore:
+            response = await self.http_client.get(path, params=params, headers={"Authorization": f"Bearer {self.creds.token}"})
+        response.raise_for_status()
+        return response.json()
+
+    async def build_email_list_async(self, filter : str):
+        # same paging as build_email_list : until every frame has enough messages to fill its queue, or MAX_SCAN are listed
+        try:
+            queued = await asyncio.to_thread(self.queued_message_ids)
+            messages = []
+            headers = {}
+            found = {target: 0 for target in self.frames}
+            params = {"q": filter, "maxResults": self.scan_length()}
+            while len(messages) < MAX_SCAN:
+                emails = await self.api_get("messages", **params)
+                page = emails.get('messages', [])[:MAX_SCAN - len(messages)]
+                messages.extend(page)
+                page_headers = (await self.get_messages_async(self.unclassified_ids(page, queued), format='metadata', metadataHeaders=['From'], fields=METADATA_FIELDS))[0]
+                headers.update(page_headers)
+                self.count_matches(page, page_headers, queued, found)
+                if self.queues_filled(found) or 'nextPageToken' not in emails:
+                    break
+                params["pageToken"] = emails['nextPageToken']
+            print(f"Listed {len(messages)} messages")
+            return {'messages': messages, 'headers': headers}
+        except Exception as e:
+            print(f"Error in build_email_list_async: {e}")
+            return None
+
+    async def build_history_list_async(self, start_history_id : str):
+        # same as build_history_list : None if the history window expired and a full resync is needed
+        message_ids = []
+        params = {"startHistoryId": start_history_id, "historyTypes": "messageAdded"}
+        try:
+            while True:
+                response = await self.api_get("history", **params)
+                for record in response.get('history', []):
+                    for added in record.get('messagesAdded', []):
+                        message = added['message']
+                        if any(label in message.get('labelIds', []) for label in ['SPAM', 'TRASH', 'DRAFT', 'SENT']):
+                            continue
+                        if message['id'] not in message_ids:
+                            message_ids.append(message['id'])
+                if 'nextPageToken' not in response:
+                    break
+                params["pageToken"] = response['nextPageToken']
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                print(f"History {start_history_id} has expired")
+            else:
+                print(f"Error in build_history_list_async: {e}")
+            return None
+        except httpx.HTTPError as e:
+            print(f"Error in build_history_list_async: {e}")
+            return None
+
+        return {"messages": [{"id": message_id} for message_id in reversed(message_ids)], "historyId": response['historyId']}
+
+    async def get_current_history_id_async(self):
+        try:
+            return (await self.api_get("profile"))['historyId']
+        except Exception as e:
+            print(f"Error in get_current_history_id_async: {e}")
+            return None
+
+    async def get_messages_async(self, message_ids : list, **params):
+        # one request per message, all of them in flight at once (up to MAX_CONCURRENT_REQUESTS)
+        # failed requests are retried like in batch_get_messages, returns the messages and the ids that still failed
+        messages = {}
+        pending_ids = list(message_ids)
+        for attempt in range(BATCH_RETRIES + 1):
+            if attempt > 0:
+                await asyncio.sleep(BATCH_RETRY_DELAY * 2 ** (attempt - 1))
+                print(f"Retrying {len(pending_ids)} messages")
+            responses = await asyncio.gather(*(self.api_get(f"messages/{message_id}", **params) for message_id in pending_ids),
+                                             return_exceptions=True)
+            failed_ids = []
+            for message_id, response in zip(pending_ids, responses):
+                if isinstance(response, httpx.HTTPStatusError) and response.response.status_code == 404:
+                    print(f"Message {message_id} was deleted")
+                elif isinstance(response, Exception):
+                    print(f"Error fetching message {message_id}: {response}")
+                    failed_ids.append(message_id)
+                else:
+                    messages[message_id] = response
+            pending_ids = failed_ids
+            if not pending_ids:
+                break
+        return messages, pending_ids
+
+    async def pull_images_and_update_queues_async(self, emails_to_parse : dict):
+        # returns the ids of the messages that could not be fetched, like pull_images_and_update_queues
+        queued = await asyncio.to_thread(self.queued_message_ids)
+        candidate_ids, unknown_ids = self.unknown_message_ids(emails_to_parse, queued)
+        if not unknown_ids:
+            print(f"All {len(candidate_ids)} messages are already queued")
+            return []
+
+        # Phase 1 : only pull the sender of the other candidates (a full listing already has them), and find the frames they go to
+        listed_headers = emails_to_parse.get('headers', {})
+        headers, missing_headers = await self.get_messages_async([message_id for message_id in unknown_ids if message_id not in listed_headers],
+                                                                 format='metadata', metadataHeaders=['From'], fields=METADATA_FIELDS)
+        headers.update({message_id: listed_headers[message_id] for message_id in unknown_ids if message_id in listed_headers})
+        ids_by_frame = self.ids_sent_to_frames(headers, candidate_ids, queued)
+        ids_to_fetch = self.ids_to_fetch(candidate_ids, ids_by_frame)
+
+        # Phase 2 : pull the parts of the remaining messages, without the payloads we don't use
+        messages, missing_messages = await self.get_messages_async(ids_to_fetch, format='full', fields=FULL_FIELDS)
+        print(f"Fetched {len(ids_to_fetch)} of {len(candidate_ids)} messages concurrently")
+
+        for target, message_ids in ids_by_frame.items():
+            await asyncio.to_thread(self.queue_messages, messages, message_ids, target)
+
+        return missing_headers + missing_messages
+
+    async def pull_attachments_async(self):
+        # same steps as pull_attachments : one scan of the inbox for all the frames
+        print(f"Pulling attachments for {len(self.frames)} frames")
+
+        if self.incremental:
+            history_id = await asyncio.to_thread(self.load_sync_position)
+            if history_id:
+                new_emails = await self.build_history_list_async(history_id)
+                if new_emails is not None:
+                    missing_ids = await self.pull_images_and_update_queues_async(new_emails) if new_emails['messages'] else []
+                    if missing_ids:
+                        print(f"{len(missing_ids)} messages could not be fetched, they will be retried at the next sync")
+                        return
+                    await asyncio.to_thread(self.save_sync_position, new_emails['historyId'])
+                    return
+                print("Falling back to a full resync")
+
+            history_id = await self.get_current_history_id_async()
+
+        list_of_emails = await self.build_email_list_async(search_filter(self.frames.values()))
+
+        missing_ids = []
+        if list_of_emails and 'messages' in list_of_emails:
+            missing_ids = await self.pull_images_and_update_queues_async(list_of_emails)
+
+        if missing_ids:
+            print(f"{len(missing_ids)} messages could not be fetched, they will be retried at the next sync")
+        elif self.incremental and history_id and list_of_emails is not None:
+            await asyncio.to_thread(self.save_sync_position, history_id)
+
+    async def fetch_attachment_async(self, temporary_attachment_id, message_id, unique_attachment_id = None):
+        # bytes of the attachment, from the local copy if we already downloaded it
+        file_data = await asyncio.to_thread(self.attachment_store.get, unique_attachment_id) if unique_attachment_id else None
+
+        if file_data is None:
+            img_data = await self.api_get(f"messages/{message_id}/attachments/{temporary_attachment_id}")
+            file_data = base64.urlsafe_b64decode(img_data['data'].encode('UTF-8'))
+            if unique_attachment_id:
+                await asyncio.to_thread(self.attachment_store.put, unique_attachment_id, file_data)
+
+        return file_data
+
+    async def pull_specific_image_async(self, temporary_attachment_id, message_id, unique_attachment_id = None):
+        file_data = await self.fetch_attachment_async(temporary_attachment_id, message_id, unique_attachment_id)
+        return Image.open(io.BytesIO(file_data))
+
+    async def render_pending_frames_async(self, target : str):
+        # download the attachments of the new images concurrently, then render the frames in a worker thread :
+        # render_pending_frames finds the attachments in the attachment store
+        # the images that already left the queue are skipped by render_pending_frames, don't download them
+        pending_frames = [email_image for email_image in self.pending_frames[target] if self.is_queued(target, email_image)]
+        results = await asyncio.gather(*(self.fetch_attachment_async(email_image.temporary_attachment_id, email_image.message_id, email_image.unique_attachment_id)
+                                         for email_image in pending_frames), return_exceptions=True)
+        for email_image, result in zip(pending_frames, results):
+            if isinstance(result, Exception):
+                print(f"Error fetching attachment {email_image.unique_attachment_id}: {result}")
+        await asyncio.to_thread(self.render_pending_frames, target)
+
+    async def aclose(self):
+        await self.http_client.aclose()
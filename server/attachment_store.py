@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Local store of the attachments downloaded from Gmail
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+# find script directory
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+
+class AttachmentStore():
+    # An image is displayed for a whole day, so its attachment would otherwise be downloaded and decoded on every request.
+    # Decoded attachments are stored once per content (sha256 of the bytes), and an index maps every
+    # unique_attachment_id to its content. The index is kept on disk so that a restarted instance starts warm.
+    # When the store grows over max_bytes, the least recently used attachments that are no longer in any queue are evicted.
+
+    def __init__(self, store_dir : str = os.path.join(dir_path, 'cache', 'attachments'), max_bytes : int = 200 * 1024 * 1024, referenced_ids = None):
+        self.store_dir = store_dir
+        self.max_bytes = max_bytes
+        # function returning the unique_attachment_ids that are still in a queue
+        self.referenced_ids = referenced_ids or (lambda: set())
+        self._index_path = os.path.join(store_dir, 'index.json')
+        self._lock = threading.Lock()
+
+        # unique_attachment_id -> {"digest", "size", "last_access"}
+        self._index = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path, 'r') as file:
+                self._index = json.load(file)
+
+    def _blob_path(self, digest : str):
+        return os.path.join(self.store_dir, 'blobs', digest[:2], digest)
+
+    def get(self, unique_attachment_id : str):
+        # return the decoded attachment, or None if it is not in the store
+        with self._lock:
+            entry = self._index.get(unique_attachment_id)
+            if entry is None:
+                return None
+            entry["last_access"] = time.time()
+
+        try:
+            with open(self._blob_path(entry["digest"]), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            # the blob was removed behind our back, forget it
+            with self._lock:
+                self._index.pop(unique_attachment_id, None)
+            return None
+
+    def put(self, unique_attachment_id : str, data : bytes):
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self._blob_path(digest)
+
+        # the same picture sent twice is only stored once
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            temporary_path = f'{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temporary_path, 'wb') as file:
+                file.write(data)
+            os.replace(temporary_path, blob_path)
+
+        with self._lock:
+            self._index[unique_attachment_id] = {"digest": digest, "size": len(data), "last_access": time.time()}
+            self._evict()
+            self._save_index()
+
+    def _evict(self):
+        # called with the lock held
+        sizes = {entry["digest"]: entry["size"] for entry in self._index.values()}
+        total_size = sum(sizes.values())
+        if total_size <= self.max_bytes:
+            return
+
+        referenced_ids = self.referenced_ids()
+        candidates = sorted((entry["last_access"], unique_attachment_id) for unique_attachment_id, entry in self._index.items() if unique_attachment_id not in referenced_ids)
+
+        for _, unique_attachment_id in candidates:
+            if total_size <= self.max_bytes:
+                break
+            digest = self._index.pop(unique_attachment_id)["digest"]
+
+            # only delete the content if no other attachment points to it
+            if any(entry["digest"] == digest for entry in self._index.values()):
+                continue
+            try:
+                os.remove(self._blob_path(digest))
+            except FileNotFoundError:
+                pass
+            total_size -= sizes[digest]
+
+    def _save_index(self):
+        # called with the lock held
+        os.makedirs(self.store_dir, exist_ok=True)
+        with open(self._index_path + '.tmp', 'w') as file:
+            json.dump(self._index, file)
+        os.replace(self._index_path + '.tmp', self._index_path)
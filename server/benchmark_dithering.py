@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Benchmark of the dithering modes on a full 480x800 frame, to pick a quality/CPU tradeoff
+# Runs on the server, and on the Pi if copied next to screen/dithering.py
+# Usage : python benchmark_dithering.py [repeats]
+
+import sys
+import time
+
+from PIL import Image
+
+from dithering import dither, DITHER_MODES
+
+# size of the frame in portrait mode
+W = 480
+H = 800
+
+
+def make_frame():
+    # smooth gradients and noise, like a photo once resized to the frame
+    noise = Image.effect_noise((W, H), 40)
+    gradient = Image.radial_gradient("L").resize((W, H))
+    return Image.blend(gradient, noise, 0.3)
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    frame = make_frame()
+
+    print(f"{'mode':>16} {'best (ms)':>10} {'mean (ms)':>10}")
+    for mode in DITHER_MODES:
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            dither(frame, mode)
+            timings.append(time.perf_counter() - start)
+        print(f"{mode:>16} {min(timings) * 1000:>10.1f} {sum(timings) / len(timings) * 1000:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
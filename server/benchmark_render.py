@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Benchmark of Image_transform.render on pictures of increasing size
+# Compares the full decode of previous versions with the reduced decode, and reports render time and peak memory.
+# Every render runs in a fresh process, so that the peak RSS of one case doesn't hide the next one.
+# Usage : python benchmark_render.py [megapixels ...]
+
+import os
+import sys
+import time
+import resource
+import tempfile
+import multiprocessing
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from eink_image import Image_transform
+
+# sizes of the test pictures, in megapixels
+DEFAULT_SIZES = [2, 12, 24, 50]
+REPEATS = 3
+
+
+def make_picture(megapixels, path):
+    # 4:3 portrait-like picture stored in landscape with an exif rotation, like most phone pictures
+    height = int((megapixels * 1e6 * 3 / 4) ** 0.5)
+    width = int(height * 4 / 3)
+    # noise and a gradient so that the jpeg is as costly to decode as a photo
+    image = Image.merge("RGB", [Image.effect_noise((width, height), 60).convert("L"),
+                                Image.linear_gradient("L").resize((width, height)),
+                                Image.radial_gradient("L").resize((width, height))])
+    exif = image.getexif()
+    exif[0x0112] = 6
+    image.save(path, "JPEG", quality=90, exif=exif)
+
+
+def legacy_render(image, w=480, h=800):
+    # render path of previous versions : full decode, full exif transpose, resize of the whole picture, then crop
+    canvas = Image.new(mode="1", size=(w, h), color=255)
+    image = ImageOps.exif_transpose(image)
+    hpercent = (h/float(image.size[1]))
+    wsize = int((float(image.size[0])*float(hpercent)))
+    image = image.resize((wsize,h), Image.LANCZOS)
+    image = image.crop(((image.size[0] - w)/2, 0, (image.size[0] + w)/2, h))
+    canvas.paste(image, (0, 0))
+    return canvas
+
+
+def run_case(path, mode, results):
+    # runs in a child process
+    with open(path, 'rb') as file:
+        data = file.read()
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        image = Image.open(BytesIO(data))
+        if mode == "full decode":
+            legacy_render(image)
+        else:
+            # render without the caption, to only measure the image path
+            Image_transform(imported_image=image, message="").render(fit="crop")
+        timings.append(time.perf_counter() - start)
+
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((min(timings), peak_rss / 1024, (peak_rss - baseline_rss) / 1024))
+
+
+def main():
+    sizes = [float(size) for size in sys.argv[1:]] or DEFAULT_SIZES
+    context = multiprocessing.get_context("spawn")
+
+    print(f"{'picture':>10} {'path':>16} {'time (ms)':>10} {'peak RSS (MB)':>14} {'RSS growth (MB)':>16}")
+    with tempfile.TemporaryDirectory() as directory:
+        for megapixels in sizes:
+            path = os.path.join(directory, f'{megapixels}mp.jpg')
+            make_picture(megapixels, path)
+
+            for mode in ["full decode", "reduced decode"]:
+                results = context.Queue()
+                process = context.Process(target=run_case, args=(path, mode, results))
+                process.start()
+                render_time, peak_rss, rss_growth = results.get()
+                process.join()
+                print(f"{str(megapixels) + ' MP':>10} {mode:>16} {render_time * 1000:>10.0f} {peak_rss:>14.0f} {rss_growth:>16.0f}")
+
+
+if __name__ == '__main__':
+    main()
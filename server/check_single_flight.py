@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Check that concurrent requests for the same frame share one Gmail pull and one render
+# Fires N requests at the same moment through the Flask test client, with the Gmail calls replaced by slow counters,
+# and fails if the inbox was pulled or the frame rendered more than once.
+# The queues and caches go to a temporary directory. The background ingest thread is not started.
+# Usage : python check_single_flight.py [requests]
+
+import sys
+import time
+import tempfile
+import threading
+from collections import Counter
+
+from PIL import Image
+from google.oauth2.credentials import Credentials
+
+import main
+from gmail_connector import GmailConnector
+from queue_store import SqliteQueueStore
+from frame_cache import FrameCache
+
+# time taken by the fake Gmail calls, long enough for all the requests to arrive while the first one runs
+GMAIL_DELAY = 0.5
+
+calls = Counter()
+calls_lock = threading.Lock()
+
+
+def count(name):
+    with calls_lock:
+        calls[name] += 1
+
+
+def fake_pull_attachments(self):
+    count("inbox scan")
+    time.sleep(GMAIL_DELAY)
+    for target in self.frames:
+        self.append_image_information(target, f"{target}_message_1", "attachment", f"{target}_message", "Hello")
+
+
+def fake_pull_specific_image(self, temporary_attachment_id, message_id, unique_attachment_id=None):
+    count("attachment")
+    time.sleep(GMAIL_DELAY)
+    return Image.radial_gradient("L").resize((600, 800))
+
+
+def main_check():
+    n_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+
+    with tempfile.TemporaryDirectory() as directory:
+        main.queue_store = SqliteQueueStore(f"{directory}/queues.sqlite3")
+        main.frame_cache = FrameCache(cache_dir=f"{directory}/frames")
+        main.generate_credentials = lambda: Credentials(token="check")
+        main.start_ingest_thread = lambda: None
+        GmailConnector.pull_attachments = fake_pull_attachments
+        GmailConnector.pull_specific_image = fake_pull_specific_image
+
+        # every thread waits at the barrier, so that the requests start together
+        barrier = threading.Barrier(n_requests)
+        responses = [None] * n_requests
+
+        def request(index, route):
+            client = main.app.test_client()
+            barrier.wait()
+            responses[index] = client.get(route)
+
+        routes = ["/earth_frame" if index % 4 == 0 else "/satellite_frame" for index in range(n_requests)]
+        threads = [threading.Thread(target=request, args=(index, route)) for index, route in enumerate(routes)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        print(f"{n_requests} concurrent requests answered in {elapsed:.2f} s")
+        for name, number in sorted(calls.items()):
+            print(f"{name:>24} : {number}")
+
+        failures = []
+        for index, (route, response) in enumerate(zip(routes, responses)):
+            if response.status_code != 200:
+                failures.append(f"request {index} to {route} answered {response.status_code}")
+        for route in set(routes):
+            if len({response.data for response, request_route in zip(responses, routes) if request_route == route}) != 1:
+                failures.append(f"the requests to {route} got different frames")
+        # the inbox is scanned once for all the frames
+        if calls["inbox scan"] != 1:
+            failures.append(f"{calls['inbox scan']} scans of the inbox instead of 1")
+        # one render per frame
+        if calls["attachment"] != 2:
+            failures.append(f"{calls['attachment']} attachment downloads instead of 2")
+
+        if failures:
+            raise SystemExit("\n".join(failures))
+        print("OK : one scan of the inbox and one render per frame")
+
+
+if __name__ == '__main__':
+    main_check()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Keeps the Gmail API credentials in memory and refreshes them before they expire
+
+import os
+import threading
+from datetime import datetime
+
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+
+# refresh the access token this many seconds before it expires
+REFRESH_MARGIN = 300
+# wait this many seconds before trying again when a refresh fails
+RETRY_DELAY = 60
+
+
+class CredentialManager():
+    # The access token lives for one hour. Instead of reading the token file and refreshing inline on every request,
+    # the credentials are loaded once and refreshed ahead of expiry by a background timer.
+    # A lock makes sure that only one thread refreshes them, and the token file is only rewritten when the token changed.
+    # Requests never wait for the background refresh : the token is refreshed in place while it is still valid.
+
+    def __init__(self, token_file : str, scopes : list, refresh_margin : int = REFRESH_MARGIN):
+        self.token_file = token_file
+        self.scopes = scopes
+        self.refresh_margin = refresh_margin
+        self._credentials = None
+        # protects the credentials reference and the timer, never held during a network call
+        self._lock = threading.RLock()
+        # one refresh at a time, held during the OAuth round trip
+        self._refresh_lock = threading.Lock()
+        self._timer = None
+
+    def get(self):
+        # return the credentials, or None if the auth flow was never completed
+        # deleting the token file starts over (see /revoke) : the credentials kept in memory are dropped
+        if not os.path.exists(self.token_file):
+            if self._credentials is not None:
+                self.clear()
+            return None
+
+        # valid credentials are returned without any lock, reading the reference is atomic
+        credentials = self._credentials
+        if credentials is not None and credentials.valid:
+            return credentials
+
+        with self._lock:
+            if self._credentials is None:
+                if not os.path.exists(self.token_file):
+                    return None
+                self._credentials = Credentials.from_authorized_user_file(self.token_file, self.scopes)
+                self._schedule_refresh()
+
+            credentials = self._credentials
+
+        # only refresh inline if the background refresh did not happen in time (e.g. CPU throttled between requests)
+        if not credentials.valid:
+            self.refresh()
+
+        return credentials
+
+    def set_credentials(self, credentials : Credentials):
+        # store the credentials obtained at the end of the auth flow
+        with self._lock:
+            self._credentials = credentials
+            self._save()
+            self._schedule_refresh()
+
+    def refresh(self):
+        with self._refresh_lock:
+            credentials = self._credentials
+            if credentials is None:
+                return
+
+            # another thread may have refreshed the credentials while we were waiting for the lock
+            if credentials.valid and self._seconds_before_refresh(credentials) > 0:
+                return
+
+            previous_token = credentials.token
+            try:
+                credentials.refresh(Request())
+                print("Credentials refreshed!")
+            except Exception as e:
+                print(f"Error refreshing credentials: {e}")
+                with self._lock:
+                    self._schedule_refresh(delay=RETRY_DELAY)
+                return
+
+            with self._lock:
+                # new credentials may have been set by the auth flow during the refresh, they are already saved
+                if self._credentials is not credentials:
+                    return
+
+                #Save credentials to file if they were refreshed
+                if credentials.token != previous_token:
+                    self._save()
+
+                self._schedule_refresh()
+
+    def clear(self):
+        # forget the credentials, e.g. after they were revoked : the next get() reads the token file again
+        with self._lock:
+            self._credentials = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def stop(self):
+        # cancel the background refresh
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _seconds_before_refresh(self, credentials : Credentials):
+        # expiry is a naive datetime in UTC
+        if credentials.expiry is None:
+            return 0
+        return (credentials.expiry - datetime.utcnow()).total_seconds() - self.refresh_margin
+
+    def _schedule_refresh(self, delay : float = None):
+        # (re)start the timer that refreshes the credentials ahead of expiry
+        if delay is None:
+            delay = max(self._seconds_before_refresh(self._credentials), 0)
+
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self.refresh)
+        # don't keep the process alive just for the timer
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _save(self):
+        # write to a temporary file first, so that the token file is never left half written
+        temporary_file = f'{self.token_file}.tmp'
+        with open(temporary_file, 'w') as token:
+            token.write(self._credentials.to_json())
+        os.replace(temporary_file, self.token_file)
+        print("Credentials saved to file!")
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Tone reduction of grayscale pictures to the black and white pixels of the e-ink screen
+# The same module is used by the Pi (screen/dithering.py)
+
+from functools import lru_cache
+
+from PIL import Image
+
+# numpy is only imported by the modes that need it : the default mode and the Pi's framebuffer path work without it
+
+# available modes, from the best looking to the cheapest
+DITHER_MODES = ["floyd-steinberg", "atkinson", "bayer", "threshold"]
+# Floyd-Steinberg is what Pillow did implicitly when pasting a picture on the black and white canvas
+DEFAULT_DITHER = "floyd-steinberg"
+
+
+def bayer_matrix(size : int = 8):
+    # ordered dithering matrix with values from 0 to size*size-1
+    import numpy as np
+    matrix = np.array([[0, 2], [3, 1]])
+    while matrix.shape[0] < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return matrix
+
+@lru_cache(maxsize=None)
+def bayer_thresholds():
+    # thresholds of the 8x8 ordered dithering, spread over 0-255
+    return (bayer_matrix(8) + 0.5) * (256 / 64)
+
+
+def dither(image : Image, mode : str = DEFAULT_DITHER, threshold : int = 128):
+    # convert a picture to a black and white ("1" mode) image
+    if mode not in DITHER_MODES:
+        raise ValueError(f"Unknown dithering mode {mode}, use one of {DITHER_MODES}")
+
+    gray = image.convert("L")
+
+    # Pillow's error diffusion is implemented in C
+    if mode == "floyd-steinberg":
+        return gray.convert("1", dither=Image.FLOYDSTEINBERG)
+
+    import numpy as np
+    pixels = np.asarray(gray)
+    if mode == "threshold":
+        bits = pixels >= threshold
+    elif mode == "bayer":
+        bits = ordered_dither(pixels)
+    elif mode == "atkinson":
+        bits = atkinson_dither(pixels)
+
+    # boolean arrays become "1" mode images
+    return Image.fromarray(bits)
+
+
+def ordered_dither(pixels):
+    # compare every pixel with the threshold of its position in the tiled Bayer matrix (pixels is a numpy array)
+    import numpy as np
+    height, width = pixels.shape
+    thresholds = np.tile(bayer_thresholds(), (height // 8 + 1, width // 8 + 1))[:height, :width]
+    return pixels > thresholds
+
+
+def atkinson_dither(pixels):
+    # Atkinson error diffusion : 1/8 of the error goes to x+1 and x+2 on the same row,
+    # to x-1, x and x+1 on the next row, and to x two rows down (the remaining 1/4 is dropped, which keeps the contrast).
+    # Only the same-row part depends on the previous pixel : it runs in a plain loop on a Python list,
+    # and the error sent to the next rows is added for the whole row at once.
+    import numpy as np
+    height, width = pixels.shape
+
+    # two columns on each side and two rows below catch the error that falls outside the picture
+    buffer = np.zeros((height + 2, width + 4), dtype=np.float32)
+    buffer[:height, 2:width + 2] = pixels
+
+    bits = np.empty((height, width), dtype=bool)
+    errors = np.empty(width, dtype=np.float32)
+
+    for y in range(height):
+        row = buffer[y].tolist()
+        row_bits = [False] * width
+        row_errors = [0.0] * width
+
+        for x in range(width):
+            old = row[x + 2]
+            if old >= 128:
+                row_bits[x] = True
+                error = (old - 255) / 8
+            else:
+                error = old / 8
+            row[x + 3] += error
+            row[x + 4] += error
+            row_errors[x] = error
+
+        bits[y] = row_bits
+        errors[:] = row_errors
+        buffer[y + 1, 1:width + 1] += errors
+        buffer[y + 1, 2:width + 2] += errors
+        buffer[y + 1, 3:width + 3] += errors
+        buffer[y + 2, 2:width + 2] += errors
+
+    return bits
@@ -1,24 +1,26 @@
-import os
-from PIL import Image, ImageDraw, ImageFont, ImageOps
-import textwrap
+from PIL import Image, ImageOps
+import math
+
+from dithering import dither, DEFAULT_DITHER
+from text_layout import draw_caption
 
 
 
 #function to transform the pic pulled from gmail into a 2 tone & resized image
 class Image_transform:
-    def __init__(self, imported_image, fit="crop", message=""):
+    def __init__(self, imported_image, fit="crop", message="", dither_mode=DEFAULT_DITHER):
         self.imported_image=imported_image
         self.message=message
+        self.dither_mode=dither_mode # how the shades of gray are turned into black and white pixels, see dithering.py
 
-    def render(self, fit="crop"):
+    def render(self, fit="crop", size=(480, 800)):
         # fit can be "width" or "crop" or "height"
+        # size is the size of the panel (see PANELS in frame_registry.py)
         #we are using the screen in portrait mode and so flipping the default landscape mode
-        w = 480
-        h = 800
+        w, h = size
         
         #create canvas in portrait mode
         canvas = Image.new(mode="1", size=(w, h), color=255) #fill colour for blank space (so, clear frame first)
-        draw = ImageDraw.Draw(canvas)
         
         #use the line below if we're working with a path and not an image file
         #image = Image.open(self.imported_image)
@@ -26,7 +28,10 @@ class Image_transform:
         #use the line below if we're working with an image file directly
         image = self.imported_image
 
-        #Remove exif orientation
+        #Decode at reduced resolution : phone pictures are much larger than the frame
+        image = self.reduce_on_decode(image, w, h, fit)
+
+        #Remove exif orientation (cheap now that the image is small)
         image = ImageOps.exif_transpose(image)
         
         #option 1 : fit the whole width to the frame
@@ -34,14 +39,14 @@ class Image_transform:
             #Resize image to fit width
             wpercent = (w/float(image.size[0]))
             hsize = int((float(image.size[1])*float(wpercent)))
-            image = image.resize((w,hsize), Image.ANTIALIAS)
+            image = image.resize((w,hsize), Image.LANCZOS, reducing_gap=3.0)
             
             #center the image vertically in the middle of the frame
             blank_space=h-image.size[1]
             adjust_height=int(blank_space/2)
             
             #paste on canvas with height adjustment
-            canvas.paste(image, (0, 0+adjust_height))
+            canvas.paste(dither(image, self.dither_mode), (0, 0+adjust_height))
 
         #option 2 : fit the whole height to the frame
         if fit=="height":
@@ -49,48 +54,73 @@ class Image_transform:
             #Resize image by height
             hpercent = (h/float(image.size[1]))
             wsize = int((float(image.size[0])*float(hpercent)))
-            image = image.resize((wsize,h), Image.ANTIALIAS)
+            image = image.resize((wsize,h), Image.LANCZOS, reducing_gap=3.0)
             
             #center 
             blank_space=h-image.size[1]
             adjust_height=int(blank_space/2)
             #Paste image on canvas
-            canvas.paste(image, (0, 0+adjust_height))
+            canvas.paste(dither(image, self.dither_mode), (0, 0+adjust_height))
 
         #option 3 : crop the image in the center 
         if fit=="crop":
         
-            #Resize image by height
+            #Size of the image once resized by height
             hpercent = (h/float(image.size[1]))
             wsize = int((float(image.size[0])*float(hpercent)))
-            image = image.resize((wsize,h), Image.ANTIALIAS)
-            
-            #Center the image on the frame. First, set overflow
-            left = (image.size[0] - w)/2
-            top = (image.size[1] - h)/2
-            right = (image.size[0] + w)/2
-            bottom = (image.size[1] + h)/2
-            
-            # Crop the center of the image
-            image = image.crop((left, top, right, bottom))
+
+            if wsize >= w:
+                #Center the image on the frame. Compute the crop box in the coordinates of the original image,
+                #so that only the visible part of the image is resized
+                left = (image.size[0] - w/hpercent)/2
+                right = (image.size[0] + w/hpercent)/2
+                image = image.resize((w,h), Image.LANCZOS, box=(left, 0, right, image.size[1]), reducing_gap=3.0)
+
+            else:
+                #the image is narrower than the frame once resized : resize it whole
+                image = image.resize((wsize,h), Image.LANCZOS, reducing_gap=3.0)
+
+                #Center the image on the frame. First, set overflow
+                left = (image.size[0] - w)/2
+                top = (image.size[1] - h)/2
+                right = (image.size[0] + w)/2
+                bottom = (image.size[1] + h)/2
+                
+                # Crop the center of the image
+                image = image.crop((left, top, right, bottom))
 
             #Paste image on canvas
-            canvas.paste(image, (0, 0))
+            canvas.paste(dither(image, self.dither_mode), (0, 0))
         
-        #print text on top of image
-        #set font
-        # find script directory
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        font = ImageFont.truetype(os.path.join(dir_path, "fonts", "Roboto-Medium.ttf"), 25)
-        
-        message = textwrap.fill(self.message,width=25)
-        
-        # Calculate the width and height of rendered text
-        textw, texth = draw.textsize(message, font=font)
-        text_overflow = (w-textw)/2
-    
-        draw.text((0+text_overflow, 0), message, font=font, fill=0, align='center')
+        #print text on top of image, the caption is rendered once and pasted on every frame that shows it
+        draw_caption(canvas, self.message)
         
         return(canvas)
 
+    @staticmethod
+    def reduce_on_decode(image, w, h, fit="crop"):
+        # Ask the JPEG decoder for the smallest scale (1/2, 1/4 or 1/8) that still covers the frame.
+        # The size is read from the header and the exif orientation, before any pixel is decoded.
+        # This does nothing for other formats or for images that were already loaded.
+        source_w, source_h = image.size
+
+        # orientations 5 to 8 swap width and height
+        orientation = image.getexif().get(0x0112, 1)
+        if orientation in (5, 6, 7, 8):
+            oriented_w, oriented_h = source_h, source_w
+        else:
+            oriented_w, oriented_h = source_w, source_h
+
+        # scale applied to the oriented image by render
+        if fit=="width":
+            scale = w/float(oriented_w)
+        else:
+            scale = h/float(oriented_h)
+
+        if scale < 1:
+            # the frame is black and white : decode the luminance only
+            image.draft("L", (math.ceil(source_w*scale), math.ceil(source_h*scale)))
+
+        return image
+
 
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Two-tier cache for the rendered frames served to the e-ink screens
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+# find script directory
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+
+class FrameCache():
+    # Rendered frames only change when the head of a queue or the day changes, so repeat polls from the Pi
+    # can be answered with the bytes computed the first time.
+    # Tier 1 is an in-process LRU (fast, lost when the instance restarts).
+    # Tier 2 is a directory of PNG files with size-based eviction (survives restarts of the container).
+
+    def __init__(self, cache_dir : str = os.path.join(dir_path, 'cache', 'frames'), max_memory_items : int = 16, max_disk_bytes : int = 50 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_memory_items = max_memory_items # number of frames kept in memory
+        self.max_disk_bytes = max_disk_bytes # total size of the frames kept on disk
+        self._memory = OrderedDict()
+        # gunicorn serves requests from several threads
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(target : str, unique_attachment_id : str, display_date, fit : str, text : str, dither_mode : str = ""):
+        # build a file-system safe key from everything that changes the rendered frame
+        raw_key = "\x1f".join([target, unique_attachment_id, str(display_date), fit, text or "", dither_mode])
+        return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+    def _path(self, key : str):
+        return os.path.join(self.cache_dir, f'{key}.png')
+
+    def get(self, key : str):
+        # look in memory first
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+
+        # then on disk
+        try:
+            with open(self._path(key), 'rb') as file:
+                frame = file.read()
+        except FileNotFoundError:
+            return None
+
+        # refresh the access time so that disk eviction is least-recently-used
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+
+        self._remember(key, frame)
+        return frame
+
+    def put(self, key : str, frame : bytes, persist : bool = True):
+        # persist can be set to False when the frame is already stored on disk elsewhere
+        self._remember(key, frame)
+        if not persist:
+            return
+
+        # write to a temporary file first so that a concurrent reader never sees a partial frame
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temporary_path = f'{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(frame)
+        os.replace(temporary_path, self._path(key))
+
+        self._evict_disk()
+
+    def _remember(self, key : str, frame : bytes):
+        with self._lock:
+            self._memory[key] = frame
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_items:
+                self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        # remove the least recently used frames until the cache fits in its budget
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith('.png')]
+        except FileNotFoundError:
+            return
+
+        entries = sorted(entries, key=lambda entry: entry.stat().st_mtime)
+        total_size = sum(entry.stat().st_size for entry in entries)
+
+        for entry in entries:
+            if total_size <= self.max_disk_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                total_size -= size
+            except FileNotFoundError:
+                # another thread already evicted it
+                pass
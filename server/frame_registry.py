@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Frames served by the app, loaded from frames.json
+# Each frame has its own queue, filled with the emails whose sender matches its rules,
+# and its own layout : fit of the pictures, dithering and size of the panel.
+#
+# frames.json :
+# {"frames": [{"name": "satellite_frame", "exclude": ["owner@example.com"]},
+#             {"name": "earth_frame", "include": ["owner@example.com"], "queue_length": 5, "fit": "width"}]}
+#
+# include : addresses whose emails go to the frame (everyone if empty)
+# exclude : addresses whose emails never go to the frame
+# an address is matched exactly, and "@example.com" matches every address of the domain
+# queue_length, fit, dither and panel are optional, see the defaults below
+
+import os
+import re
+import json
+from email.utils import parseaddr
+
+from dithering import DITHER_MODES, DEFAULT_DITHER
+
+# find script directory
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+FRAMES_FILE = os.environ.get("FRAMES_FILE", os.path.join(dir_path, "frames.json"))
+
+#number of images kept in each queue (one image is displayed per day)
+DEFAULT_QUEUE_LENGTH = int(os.environ.get("QUEUE_LENGTH", 10))
+#layout of the frames rendered at ingest time
+DEFAULT_FIT = "crop"
+FITS = ["crop", "width", "height"]
+#size of the rendered frames for each panel, in portrait mode
+PANELS = {"epd7in5_V2": (480, 800)}
+DEFAULT_PANEL = "epd7in5_V2"
+
+# the name is used in the URL and in the paths of the queues and frames
+NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class Frame():
+    # Rules and layout of one frame
+
+    def __init__(self, name : str, include : list = (), exclude : list = (), queue_length : int = DEFAULT_QUEUE_LENGTH,
+                 fit : str = DEFAULT_FIT, dither : str = DEFAULT_DITHER, panel : str = DEFAULT_PANEL):
+        if not NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid frame name {name!r}: use letters, digits, _ and -")
+        if fit not in FITS:
+            raise ValueError(f"Unknown fit {fit} for frame {name}, use one of {FITS}")
+        if dither not in DITHER_MODES:
+            raise ValueError(f"Unknown dithering mode {dither} for frame {name}, use one of {DITHER_MODES}")
+        if panel not in PANELS:
+            raise ValueError(f"Unknown panel {panel} for frame {name}, use one of {list(PANELS)}")
+        if queue_length < 1:
+            raise ValueError(f"The queue of frame {name} must hold at least one image")
+
+        self.name = name
+        # the addresses are compared without case, like Gmail does
+        self.include = [email.lower() for email in include]
+        self.exclude = [email.lower() for email in exclude]
+        self.queue_length = queue_length
+        self.fit = fit
+        self.dither = dither
+        self.panel = panel
+
+    @property
+    def size(self):
+        return PANELS[self.panel]
+
+    def matches(self, sender : str):
+        # sender is the From header of the email, e.g. "Name <name@example.com>"
+        address = parseaddr(sender)[1].lower()
+        if matches_any(address, self.exclude):
+            return False
+        return not self.include or matches_any(address, self.include)
+
+    @staticmethod
+    def from_dict(data : dict):
+        return Frame(**data)
+
+
+def matches_any(address : str, rules : list):
+    # rules are addresses, or domains starting with @
+    domain = "@" + address.rpartition("@")[2]
+    return any(rule == address or rule == domain for rule in rules)
+
+
+def load_frames(file_path : str = FRAMES_FILE):
+    # frames by name, in the order of the file
+    with open(file_path, 'r') as file:
+        frames = [Frame.from_dict(frame) for frame in json.load(file)["frames"]]
+
+    if not frames:
+        raise ValueError(f"No frame defined in {file_path}")
+    names = [frame.name for frame in frames]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"Frames defined twice in {file_path}: {', '.join(sorted(duplicates))}")
+
+    return {frame.name: frame for frame in frames}
+
+
+def search_filter(frames : list):
+    # Gmail query returning every email that can go to at least one of the frames
+    # a frame without include rule takes emails from anyone, so the whole inbox has to be listed
+    if any(not frame.include for frame in frames):
+        return ""
+    emails = sorted({email for frame in frames for email in frame.include})
+    return f"from:({' OR '.join(emails)})"
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Packed framebuffer of the 7.5 inch e-paper panel, as sent over SPI by EPD.display
+# 800x480 pixels in landscape, 1 bit per pixel, most significant bit first, 1 = black
+# The same module is used by the Pi (screen/framebuffer.py)
+
+import zlib
+
+from PIL import Image
+
+# resolution of the panel in its native (landscape) orientation
+EPD_WIDTH = 800
+EPD_HEIGHT = 480
+FRAMEBUFFER_SIZE = EPD_WIDTH // 8 * EPD_HEIGHT
+
+# content type of the framebuffer responses
+FRAMEBUFFER_MIMETYPE = "application/x-epd-framebuffer"
+COMPRESSIONS = ["none", "zlib", "rle"]
+
+# in the PIL world 0=black and 1=white, but in the e-paper world 0=white and 1=black
+INVERT_TABLE = bytes(255 - value for value in range(256))
+
+
+def to_framebuffer(frame : Image):
+    # same result as EPD.getbuffer on the Pi, computed with bulk operations
+    if frame.size == (EPD_HEIGHT, EPD_WIDTH):
+        # portrait frame : rotate it like the panel expects
+        frame = frame.transpose(Image.ROTATE_90)
+    elif frame.size != (EPD_WIDTH, EPD_HEIGHT):
+        raise ValueError(f"Wrong image dimensions: must be {EPD_WIDTH}x{EPD_HEIGHT}")
+    return frame.convert("1").tobytes().translate(INVERT_TABLE)
+
+
+def compress(buffer : bytes, compression : str = "none"):
+    if compression == "none":
+        return bytes(buffer)
+    elif compression == "zlib":
+        return zlib.compress(buffer, 9)
+    elif compression == "rle":
+        return rle_encode(buffer)
+    raise ValueError(f"Unknown compression {compression}, use one of {COMPRESSIONS}")
+
+
+def decompress(data : bytes, compression : str = "none"):
+    if compression == "none":
+        buffer = data
+    elif compression == "zlib":
+        buffer = zlib.decompress(data)
+    elif compression == "rle":
+        buffer = rle_decode(data)
+    else:
+        raise ValueError(f"Unknown compression {compression}, use one of {COMPRESSIONS}")
+
+    if len(buffer) != FRAMEBUFFER_SIZE:
+        raise ValueError(f"Wrong framebuffer size: {len(buffer)} bytes instead of {FRAMEBUFFER_SIZE}")
+    return buffer
+
+
+def rle_encode(buffer : bytes):
+    # PackBits : a header byte n from 0 to 127 is followed by n+1 literal bytes,
+    # a header byte n from 129 to 255 is followed by one byte repeated 257-n times
+    output = bytearray()
+    position = 0
+    length = len(buffer)
+
+    while position < length:
+        # length of the run starting here
+        run_end = position + 1
+        while run_end < length and run_end - position < 128 and buffer[run_end] == buffer[position]:
+            run_end += 1
+
+        if run_end - position >= 2:
+            output.append(257 - (run_end - position))
+            output.append(buffer[position])
+            position = run_end
+            continue
+
+        # literal bytes, until the next run of at least 3 bytes
+        literal_end = position + 1
+        while literal_end < length and literal_end - position < 128:
+            if literal_end + 2 < length and buffer[literal_end] == buffer[literal_end + 1] == buffer[literal_end + 2]:
+                break
+            literal_end += 1
+        output.append(literal_end - position - 1)
+        output += buffer[position:literal_end]
+        position = literal_end
+
+    return bytes(output)
+
+
+def rle_decode(data : bytes):
+    output = bytearray()
+    position = 0
+    length = len(data)
+
+    while position < length:
+        header = data[position]
+        if header < 128:
+            output += data[position + 1:position + header + 2]
+            position += header + 2
+        elif header > 128:
+            output += bytes([data[position + 1]]) * (257 - header)
+            position += 2
+        else:
+            # 128 is a no-op
+            position += 1
+
+    return bytes(output)
@@ -1,35 +1,66 @@
 # -*- coding: utf-8 -*-
 
-from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 import base64
 import re
 import io
 from PIL import Image
 import json
 import os
+import time
+import threading
 
 from zoneinfo import ZoneInfo
 from datetime import datetime, timedelta
 
 from google.oauth2.credentials import Credentials
 
-from collections import deque
+from collections import defaultdict
+from itertools import islice
+from bisect import bisect_left
+
+from gmail_service import service_pool
+from attachment_store import AttachmentStore
+from queue_store import JsonQueueStore
+from frame_registry import search_filter
+from single_flight import KeyedLocks
 
 # find script directory
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
-DATE_NOW = datetime.now(ZoneInfo("America/New_York")).date()
+# time zone used to decide which day it is
+TIMEZONE = "America/New_York"
+
+def today():
+    # default clock of the queues : evaluated on every call, so that long-lived workers don't get stuck on the day they started
+    return datetime.now(ZoneInfo(TIMEZONE)).date()
+
+# Gmail accepts up to 100 calls per batch request, but recommends staying under 50
+BATCH_SIZE = 50
+# messages that fail inside a batch (often 429 when Gmail rate limits the parts of a batch) are sent again in a new batch,
+# after a delay doubled at each retry
+BATCH_RETRIES = 3
+BATCH_RETRY_DELAY = 1
+# most emails listed by a full resync : the listing goes on until every frame has enough emails to fill its queue,
+# this stops it when the senders of a frame are rare or gone
+MAX_SCAN = 500
+# partial responses : only ask Gmail for the fields that are parsed below
+METADATA_FIELDS = "id,sizeEstimate,payload/headers"
+FULL_FIELDS = "id,payload(headers,parts(partId,mimeType,filename,body(attachmentId,data),parts(mimeType,body/data)))"
 
 class EmailImage():
         # Class to store the details of an image attachment extracted from a Gmail inbox
+        # __slots__ keeps every entry small, queues can hold thousands of them
+        __slots__ = ("unique_attachment_id", "temporary_attachment_id", "message_id", "text", "image_as_string", "display_date", "frame_file")
 
-        def __init__(self, unique_attachment_id : str, temporary_attachment_id : str, message_id : str, text : str, image : Image  = None, display_date : datetime = None):
+        def __init__(self, unique_attachment_id : str, temporary_attachment_id : str, message_id : str, text : str, image : Image  = None, display_date : datetime = None, frame_file : str = None):
             self.unique_attachment_id = unique_attachment_id # fixed ID of the attachment for any API call
             self.temporary_attachment_id = temporary_attachment_id # ID of the attachment for the current API call
             self.message_id = message_id # id of the email
             self.text = text # body of the email
             self.image_as_string = image # image as a string
             self.display_date = display_date # date to show the image on the frame
+            self.frame_file = frame_file # name of the file holding the frame rendered at ingest time
 
         # Convert to dict for json serialization
         def to_dict(self):
@@ -38,86 +69,123 @@ class EmailImage():
                 "temporary_attachment_id": self.temporary_attachment_id,
                 "message_id": self.message_id,
                 "text": self.text,
-                "display_date": self.display_date.isoformat() if self.display_date else None
+                "display_date": self.display_date.isoformat() if self.display_date else None,
+                "frame_file": self.frame_file
             }
 
         @staticmethod
         # Convert from dict to EmailImage
         def from_dict(data):
             display_date = datetime.fromisoformat(data["display_date"]).date() if data["display_date"] else None
-            return EmailImage(data["unique_attachment_id"], data["temporary_attachment_id"], data["message_id"], data["text"], display_date=display_date)
+            return EmailImage(data["unique_attachment_id"], data["temporary_attachment_id"], data["message_id"], data["text"], display_date=display_date, frame_file=data.get("frame_file"))
 
 
 class FIFOQueue():
     # First-in First-out Queue (since emails are pulled in chronological order)
-    def __init__(self, *elements):
-        self._elements = deque(elements)
+    # Display dates never decrease from the head to the tail of the queue, so the image of a given day is found by bisection.
+    # Elements are kept in a list with a moving head so that dequeue doesn't shift the whole list,
+    # and indexed by unique_attachment_id to find duplicates in constant time.
+    # clock returns today's date, it can be replaced to test the schedule
+    def __init__(self, *elements, clock = today):
+        self.clock = clock
+        self._elements = list(elements)
+        self._dates = [element.display_date for element in elements]
+        self._index = {element.unique_attachment_id: element for element in elements}
+        self._head = 0
 
     def __len__(self):
-        return len(self._elements)
+        return len(self._elements) - self._head
     
     # The __iter__ method makes the class iterable 
     def __iter__(self):
-        return iter(self._elements)
+        return islice(self._elements, self._head, None)
+
+    def __contains__(self, unique_attachment_id):
+        return unique_attachment_id in self._index
 
     def enqueue(self, element):
+        date_now = self.clock()
+
         # if queue is empty or date of previous element is in the past
-        if self.__len__() == 0 or self._elements[-1].display_date < DATE_NOW:
+        if self.__len__() == 0 or self._elements[-1].display_date < date_now:
             # add element with today's date
-            element.display_date = DATE_NOW
+            element.display_date = date_now
 
         # if display date of previous element is either today or in the future
-        elif self._elements[-1].display_date >= DATE_NOW:
+        elif self._elements[-1].display_date >= date_now:
             # add element with +1 day to the previous element
             element.display_date = self._elements[-1].display_date + timedelta(days=1)
 
         # append element
         self._elements.append(element)
+        self._dates.append(element.display_date)
+        self._index[element.unique_attachment_id] = element
 
     def dequeue(self):
         # remove first element from queue
-        return self._elements.popleft()
-
-    def save_to_file(self, file_path):
-        # save the queue to a json file - to make the queue persistent on Cloud Run we need to write it to an external file
-        with open(file_path, 'w') as file:
-            json.dump({i+1: element.to_dict() for i, element in enumerate(self._elements)}, file)
-
-    def load_from_file(self, file_path):
-        # load the queue from a json file
-        with open(file_path, 'r') as file:
-            elements = json.load(file)
-            # Ignore the keys and only use the values
-            self._elements = deque(EmailImage.from_dict(element) for element in elements.values())
+        element = self._elements[self._head]
+        self._elements[self._head] = None
+        self._head += 1
+        del self._index[element.unique_attachment_id]
+
+        # drop the removed slots once they make up half of the list
+        if self._head > 32 and self._head * 2 > len(self._elements):
+            del self._elements[:self._head]
+            del self._dates[:self._head]
+            self._head = 0
+
+        return element
+
+    def find_by_date(self, date):
+        # first element to display on this date or later, or the last element if they are all in the past
+        if self.__len__() == 0:
+            return None
+        index = bisect_left(self._dates, date, self._head)
+        return self._elements[min(index, len(self._elements) - 1)]
 
 # class that connects to Gmail and allows you to parse messages
 class GmailConnector():
 
-    def __init__(self, creds : Credentials, length_of_queue : int = 3, satellite_emails : list = []):
+    def __init__(self, creds : Credentials, frames : dict, incremental : bool = False, render_frame = None, queue_store = None, clock = today):
         self.user_id = 'me'
         # creds are the credentials used to connect to the gmail API
         self.creds = creds
         # A shared Gmail inbox is created specifically for the project. It will receive images from multiple senders.
-        # We need to create a filter to only pull images from the right sender.
-        # The satellite frame will display images receive from everyone except themselves.
-        # The earth frame will only display images from the satellite frame. 
+        # Each frame only pulls images from the right senders, following its rules (see frame_registry.py).
+        # With the default frames.json, the satellite frame displays images received from everyone except its owner,
+        # and the earth frame only displays images from the satellite frame's owner.
         # Think of it like Apollo and Houston... The spaceship can see everything sent by anyone, whereas  Houston only wants to hear from the spaceship.
-        self.length_of_queue = length_of_queue # length of the dynamic image queue
-        self.satellite_emails= satellite_emails # emails used by the satellite frame owner 
+        self.frames = frames # frames by name, each with its own queue
+        # in incremental mode, only the messages added since the last sync are fetched (using the Gmail historyId)
+        self.incremental = incremental
+        # function turning an attachment and its text into the bytes of the frame, called when a new image is enqueued
+        self.render_frame = render_frame
+        # where the queues and the sync state are persisted (json files by default, see queue_store.py)
+        self.queue_store = queue_store or JsonQueueStore()
+        # function returning today's date
+        self.clock = clock
         #create lists to attachments for all parties
-        self.image_queues = {
-            "satellite_frame": FIFOQueue(),
-            "earth_frame": FIFOQueue(),
-        }
+        #the queue of a target is only loaded from the store when it is first used, see get_queue
+        self.image_queues = {}
+        # the sync and the requests of the frames run in different threads, a queue is changed or read by one of them at a time
+        self.queue_locks = KeyedLocks()
+
+        # decoded attachments kept on disk, the ones still in a queue are never evicted
+        self.attachment_store = AttachmentStore(referenced_ids=self.referenced_attachment_ids)
+
+        # images enqueued since the last call to render_pending_frames
+        self.pending_frames = defaultdict(list)
 
-        # load queues from file if they exist
-        for target in self.image_queues:
-            full_queue_path = os.path.join(dir_path, 'queues', f'{target}_queue.json')
-            if os.path.exists(full_queue_path):
-                self.image_queues[target].load_from_file(full_queue_path)
+    def get_queue(self, target : str):
+        # load the queue of the target from the store the first time it is needed
+        if target not in self.image_queues:
+            self.image_queues[target] = FIFOQueue(*(EmailImage.from_dict(element) for element in self.queue_store.load(target)), clock=self.clock)
+        return self.image_queues[target]
 
-        # Build API call
-        self.service =  build('gmail', 'v1', credentials=self.creds)
+    @property
+    def service(self):
+        # the API client is built once per thread and reused, see gmail_service.py
+        return service_pool.get(self.creds)
 
     def get_text(self, parts):
         # get text included in the body of an email
@@ -135,56 +203,281 @@ class GmailConnector():
         return string
     
     def append_image_information(self, target, unique_attachment_id, temporary_attachment_id, message_id, body_text):
-
-        # If the image is not already in the queue
-        if unique_attachment_id not in [item.unique_attachment_id for item in self.image_queues[target]._elements]:
-            print(f"Appending image to {target} queue")
-            # store image details
-            email_image = EmailImage(unique_attachment_id=unique_attachment_id, temporary_attachment_id=temporary_attachment_id, message_id=message_id, text=body_text)
+        # the requests of the frames read the queue from other threads
+        with self.queue_locks.get(target):
+            # If the image is not already in the queue
+            if unique_attachment_id not in self.get_queue(target):
+                print(f"Appending image to {target} queue")
+                # store image details
+                email_image = EmailImage(unique_attachment_id=unique_attachment_id, temporary_attachment_id=temporary_attachment_id, message_id=message_id, text=body_text)
         
-            # if the queue is full, remove the first element
-            if len(self.image_queues[target]) == self.length_of_queue:
-                self.image_queues[target].dequeue()
+                # if the queue is full, remove the first element
+                dequeued_image = None
+                if len(self.get_queue(target)) >= self.frames[target].queue_length:
+                    dequeued_image = self.get_queue(target).dequeue()
+                    self.remove_frame(target, dequeued_image)
             
-            self.image_queues[target].enqueue(email_image)
+                self.get_queue(target).enqueue(email_image)
+
+                # persist both changes at once
+                self.queue_store.enqueue(target, email_image.to_dict(), dequeued_id=dequeued_image.unique_attachment_id if dequeued_image else None)
+
+                # the frame is rendered right away by render_pending_frames
+                if self.render_frame is not None:
+                    self.pending_frames[target].append(email_image)
     
-        else:
-            print(f"Image already in {target} queue")
-
-    def pull_specific_image(self, temporary_attachment_id, message_id):
-        #store image in utf-8 format
-        img_data = self.service.users().messages().attachments().get(userId=self.user_id, messageId=message_id,id=temporary_attachment_id).execute()
-        img_data=img_data['data'].encode('UTF-8')
-        file_data=base64.urlsafe_b64decode(img_data) #decode string
+            else:
+                print(f"Image already in {target} queue")
+
+    def frame_path(self, target : str, frame_file : str):
+        return os.path.join(dir_path, 'queues', 'frames', target, frame_file)
+
+    def is_queued(self, target : str, email_image : EmailImage):
+        # False once the image left the queue of the target
+        with self.queue_locks.get(target):
+            return email_image.unique_attachment_id in self.get_queue(target)
+
+    def render_pending_frames(self, target : str):
+        # render the frames of the images enqueued since the last call, so that requests only have to read them
+        # the queue is only locked to check that the image is still in it, not during the render
+        pending_frames, self.pending_frames[target] = self.pending_frames[target], []
+
+        for email_image in pending_frames:
+            # a sync can enqueue more images than the queue holds : skip the ones that already left it
+            if not self.is_queued(target, email_image):
+                continue
+
+            try:
+                image = self.pull_specific_image(email_image.temporary_attachment_id, email_image.message_id, email_image.unique_attachment_id)
+                frame = self.render_frame(image, email_image.text, self.frames[target])
+            except Exception as e:
+                # the frame will be rendered when it is requested instead
+                print(f"Error rendering frame for {email_image.unique_attachment_id}: {e}")
+                continue
+
+            frame_file = f'{email_image.unique_attachment_id}.png'
+            os.makedirs(os.path.dirname(self.frame_path(target, frame_file)), exist_ok=True)
+            # write to a temporary file first so that a request never reads a partial frame
+            temporary_path = f'{self.frame_path(target, frame_file)}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temporary_path, 'wb') as file:
+                file.write(frame)
+
+            # the image can leave the queue during the render, and remove_frame would not know about this file
+            with self.queue_locks.get(target):
+                if email_image.unique_attachment_id not in self.get_queue(target):
+                    os.remove(temporary_path)
+                    continue
+                os.replace(temporary_path, self.frame_path(target, frame_file))
+                email_image.frame_file = frame_file
+                self.queue_store.update(target, email_image.to_dict())
+
+    def load_frame(self, target : str, email_image : EmailImage):
+        # return the frame rendered at ingest time, or None if it is not available
+        if email_image.frame_file is None:
+            return None
+        try:
+            with open(self.frame_path(target, email_image.frame_file), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def remove_frame(self, target : str, email_image : EmailImage):
+        # delete the frame of an image that left the queue
+        if email_image.frame_file is not None:
+            try:
+                os.remove(self.frame_path(target, email_image.frame_file))
+            except FileNotFoundError:
+                pass
+
+    def referenced_attachment_ids(self):
+        # attachments that are still in a queue
+        return self.queue_store.attachment_ids()
+
+    def pull_specific_image(self, temporary_attachment_id, message_id, unique_attachment_id = None):
+        # use the local copy of the attachment if we already downloaded it
+        file_data = self.attachment_store.get(unique_attachment_id) if unique_attachment_id else None
+
+        if file_data is None:
+            #store image in utf-8 format
+            img_data = self.service.users().messages().attachments().get(userId=self.user_id, messageId=message_id,id=temporary_attachment_id).execute()
+            img_data=img_data['data'].encode('UTF-8')
+            file_data=base64.urlsafe_b64decode(img_data) #decode string
+            if unique_attachment_id:
+                self.attachment_store.put(unique_attachment_id, file_data)
+
         image_to_send=Image.open(io.BytesIO(file_data))  #open as an image
         return image_to_send
     
+    def scan_length(self):
+        # size of a page of the listing : enough to fill every queue if the frames don't share their senders
+        return min(sum(frame.queue_length for frame in self.frames.values()), MAX_SCAN)
+
+    def unclassified_ids(self, page : list, queued : dict):
+        # ids of a page of the listing whose sender is needed : a message already in every queue goes to every frame
+        return [message['id'] for message in page if any(message['id'] not in queued[target] for target in self.frames)]
+
+    def count_matches(self, page : list, headers : dict, queued : dict, found : dict):
+        # add the messages of a page that go to each frame to found, the messages without headers could not be fetched
+        for message in page:
+            message_id = message['id']
+            for target, frame in self.frames.items():
+                if message_id in queued[target] or (message_id in headers and frame.matches(self.get_sender(headers[message_id]))):
+                    found[target] += 1
+
+    def queues_filled(self, found : dict):
+        return all(found[target] >= frame.queue_length for target, frame in self.frames.items())
+
     def build_email_list(self, filter : str):   
         try:
-            emails = self.service.users().messages().list(userId=self.user_id, q = (filter)).execute()
-            return emails
+            # go through the pages of results until every frame has enough messages to fill its queue (or MAX_SCAN are listed)
+            # the filter is shared by all the frames, so the sender of each page is pulled to know where its messages go
+            # the headers are returned with the list, pull_images_and_update_queues doesn't fetch them again
+            queued = self.queued_message_ids()
+            messages = []
+            headers = {}
+            found = {target: 0 for target in self.frames}
+            request = self.service.users().messages().list(userId=self.user_id, q = (filter), maxResults = self.scan_length())
+            while request is not None and len(messages) < MAX_SCAN:
+                emails = request.execute()
+                page = emails.get('messages', [])[:MAX_SCAN - len(messages)]
+                messages.extend(page)
+                page_headers = self.batch_get_messages(self.unclassified_ids(page, queued), format='metadata', metadataHeaders=['From'], fields=METADATA_FIELDS)[0]
+                headers.update(page_headers)
+                self.count_matches(page, page_headers, queued, found)
+                if self.queues_filled(found):
+                    break
+                request = self.service.users().messages().list_next(request, emails)
+            print(f"Listed {len(messages)} messages")
+            return {'messages': messages, 'headers': headers}
         except Exception as e:
             print(f"Error in build_email_list: {e}")
             return None
     
-    def pull_images_and_update_queue(self, emails_to_parse : dict, target : str):
-        # parse emails in chronological order
+    def build_history_list(self, start_history_id : str):
+        # list the messages added to the inbox since start_history_id, newest first like messages().list
+        # returns None if the history window expired (Gmail keeps it for about a week) and a full resync is needed
+        message_ids = []
+        try:
+            request = self.service.users().history().list(userId=self.user_id, startHistoryId=start_history_id, historyTypes='messageAdded')
+            while request is not None:
+                response = request.execute()
+                for record in response.get('history', []):
+                    for added in record.get('messagesAdded', []):
+                        message = added['message']
+                        # the history covers the whole mailbox, skip what a messages().list call would not return
+                        if any(label in message.get('labelIds', []) for label in ['SPAM', 'TRASH', 'DRAFT', 'SENT']):
+                            continue
+                        if message['id'] not in message_ids:
+                            message_ids.append(message['id'])
+                request = self.service.users().history().list_next(request, response)
+        except HttpError as e:
+            if e.resp.status == 404:
+                print(f"History {start_history_id} has expired")
+            else:
+                print(f"Error in build_history_list: {e}")
+            return None
+
+        # the history is returned in chronological order
+        return {"messages": [{"id": message_id} for message_id in reversed(message_ids)], "historyId": response['historyId']}
 
-        # trim list of emails to length of queue
-        trimmed_list_of_emails = emails_to_parse['messages'][:self.length_of_queue]
+    def get_current_history_id(self):
+        # position of the mailbox right now, used as the starting point of the next incremental sync
+        try:
+            return self.service.users().getProfile(userId=self.user_id).execute()['historyId']
+        except Exception as e:
+            print(f"Error in get_current_history_id: {e}")
+            return None
 
-        for message in reversed(trimmed_list_of_emails):
-            message_id=(message['id'])
-            message_content=self.service.users().messages().get(userId=self.user_id, id=message_id, format='full').execute()
+    def batch_get_messages(self, message_ids : list, **get_parameters):
+        # fetch several messages with Gmail batch requests : one HTTP round trip for up to BATCH_SIZE messages
+        # returns the messages keyed by id, the ids that still failed after the retries,
+        # the number of round trips and the number of bytes received
+        messages = {}
+        received_bytes = 0
+        failed_ids = []
+
+        def store_message(request_id, response, exception):
+            nonlocal received_bytes
+            if exception is not None:
+                # a deleted message has nothing left to fetch, the other errors are retried
+                if isinstance(exception, HttpError) and exception.resp.status == 404:
+                    print(f"Message {request_id} was deleted")
+                else:
+                    print(f"Error fetching message {request_id}: {exception}")
+                    failed_ids.append(request_id)
+                return
+            messages[request_id] = response
+            received_bytes += len(json.dumps(response))
+
+        round_trips = 0
+        pending_ids = list(message_ids)
+        for attempt in range(BATCH_RETRIES + 1):
+            if attempt > 0:
+                time.sleep(BATCH_RETRY_DELAY * 2 ** (attempt - 1))
+                print(f"Retrying {len(pending_ids)} messages")
+            failed_ids.clear()
+            for start in range(0, len(pending_ids), BATCH_SIZE):
+                batch = self.service.new_batch_http_request(callback=store_message)
+                for message_id in pending_ids[start:start + BATCH_SIZE]:
+                    batch.add(self.service.users().messages().get(userId=self.user_id, id=message_id, **get_parameters), request_id=message_id)
+                batch.execute()
+                round_trips += 1
+            pending_ids = list(failed_ids)
+            if not pending_ids:
+                break
 
-            #find the sender
-            for header_parts in message_content['payload']['headers']:
-                if header_parts['name']== "From":
-                    sender=(header_parts['value'])
+        return messages, pending_ids, round_trips, received_bytes
+
+    def queued_message_ids(self):
+        # ids of the messages already in the queue of each frame
+        queued = {}
+        for target in self.frames:
+            with self.queue_locks.get(target):
+                queued[target] = {item.message_id for item in self.get_queue(target)}
+        return queued
+
+    def unknown_message_ids(self, emails_to_parse : dict, queued : dict):
+        # ids of the messages to look at, oldest first : the list is trimmed to MAX_SCAN messages,
+        # and messages that are already in every queue don't need any call
+        trimmed_list_of_emails = emails_to_parse['messages'][:MAX_SCAN]
+        candidate_ids = [message['id'] for message in reversed(trimmed_list_of_emails)]
+        return candidate_ids, [message_id for message_id in candidate_ids if any(message_id not in queued[target] for target in self.frames)]
+
+    def get_sender(self, message : dict):
+        # From header of a message fetched with format='metadata' or 'full'
+        sender = ""
+        for header_parts in message['payload'].get('headers', []):
+            if header_parts['name']== "From":
+                sender=(header_parts['value'])
+        return sender
+
+    def ids_sent_to_frames(self, headers : dict, message_ids : list, queued : dict):
+        # classify the messages against the rules of every frame in one pass
+        # returns the ids to queue in each frame (oldest first) : the new ones among its queue_length newest messages
+        ids_by_frame = {target: [] for target in self.frames}
+        for message_id in message_ids:
+            # messages coming from the history are not filtered by sender yet
+            # a message without headers could not be fetched, it only counts for the frames it is already queued in
+            sender = self.get_sender(headers[message_id]) if message_id in headers else None
+            for target, frame in self.frames.items():
+                if message_id in queued[target] or (sender is not None and frame.matches(sender)):
+                    ids_by_frame[target].append(message_id)
+
+        # older messages would leave the queue right away, or push out newer ones
+        for target, frame in self.frames.items():
+            ids_by_frame[target] = [message_id for message_id in ids_by_frame[target][-frame.queue_length:] if message_id not in queued[target]]
+        return ids_by_frame
+
+    def queue_messages(self, messages : dict, message_ids : list, target : str):
+        # add the attachments of the messages to the queue, in the order of message_ids
+        for message_id in message_ids:
+            if message_id not in messages:
+                continue
+            message_content = messages[message_id]
             
             #initialize body text to empty 
             body_text = ""
-            for parts in message_content['payload']['parts']:
+            for parts in message_content['payload'].get('parts', []):
                 # get text embedded in email content
                 text = self.get_text(parts)
                 # only append text if it is not empty
@@ -204,41 +497,91 @@ class GmailConnector():
 
                     self.append_image_information(target, unique_attachment_id, temporary_attachment_id, message_id, body_text)
 
+    def ids_to_fetch(self, candidate_ids : list, ids_by_frame : dict):
+        # messages wanted by at least one frame, each fetched once even if it goes to several frames
+        wanted = {message_id for message_ids in ids_by_frame.values() for message_id in message_ids}
+        return [message_id for message_id in candidate_ids if message_id in wanted]
 
-    def pull_attachments(self, target : str):
-        print(f"Pulling attachments for the {target}")
-        # target is either "satellite_frame" or "earth_frame"
-        if target == "satellite_frame": 
-            filter = f"-from:{' OR '.join([email for email in self.satellite_emails])}"
-        elif target == "earth_frame":
-            filter = f"from:{' OR '.join([email for email in self.satellite_emails])}"
-
-        list_of_emails = self.build_email_list(filter)
-
-        if list_of_emails:
-            self.pull_images_and_update_queue(list_of_emails, target)
+    def pull_images_and_update_queues(self, emails_to_parse : dict):
+        # parse emails in chronological order
+        # returns the ids of the messages that could not be fetched, the sync must not move past them
+        queued = self.queued_message_ids()
+        candidate_ids, unknown_ids = self.unknown_message_ids(emails_to_parse, queued)
+        if not unknown_ids:
+            print(f"All {len(candidate_ids)} messages are already queued")
+            return []
+
+        # Phase 1 : only pull the sender of the other candidates (a full listing already has them), and find the frames they go to
+        listed_headers = emails_to_parse.get('headers', {})
+        headers, missing_headers, metadata_round_trips, metadata_bytes = self.batch_get_messages([message_id for message_id in unknown_ids if message_id not in listed_headers],
+                                                                                                 format='metadata', metadataHeaders=['From'], fields=METADATA_FIELDS)
+        headers.update({message_id: listed_headers[message_id] for message_id in unknown_ids if message_id in listed_headers})
+        ids_by_frame = self.ids_sent_to_frames(headers, candidate_ids, queued)
+        ids_to_fetch = self.ids_to_fetch(candidate_ids, ids_by_frame)
+
+        # Phase 2 : pull the parts of the remaining messages, without the payloads we don't use
+        messages, missing_messages, full_round_trips, full_bytes = self.batch_get_messages(ids_to_fetch, format='full', fields=FULL_FIELDS)
+
+        # compare with one messages().get(format='full') per message : one round trip each,
+        # and about the size Gmail estimates for the whole message (sizeEstimate, the raw email with its attachments)
+        full_size_estimate = sum(header.get('sizeEstimate', 0) for header in headers.values())
+        print(f"Fetched {len(ids_to_fetch)} of {len(unknown_ids)} new messages in {metadata_round_trips + full_round_trips} round trips "
+              f"instead of {len(unknown_ids)}, received {metadata_bytes + full_bytes} bytes instead of ~{full_size_estimate}")
+
+        for target, message_ids in ids_by_frame.items():
+            self.queue_messages(messages, message_ids, target)
+
+        return missing_headers + missing_messages
+
+    def load_sync_position(self):
+        # the historyId is saved for each frame : a frame added to frames.json has none, and gets a full resync
+        # the frames are synced together, so they normally all share the same historyId
+        history_ids = [self.queue_store.load_history_id(target) for target in self.frames]
+        if None in history_ids:
+            return None
+        return min(history_ids, key=int)
+
+    def save_sync_position(self, history_id : str):
+        for target in self.frames:
+            self.queue_store.save_history_id(target, history_id)
+
+    def pull_attachments(self):
+        # one scan of the inbox for all the frames : each new message is classified against the rules of every frame
+        print(f"Pulling attachments for {len(self.frames)} frames")
+
+        if self.incremental:
+            history_id = self.load_sync_position()
+            if history_id:
+                # only fetch the messages added since the last sync
+                new_emails = self.build_history_list(history_id)
+                if new_emails is not None:
+                    missing_ids = self.pull_images_and_update_queues(new_emails) if new_emails['messages'] else []
+                    # the queues are persisted as they change, so the historyId can move forward without losing messages,
+                    # unless some of them could not be fetched : the next sync starts from the same historyId
+                    if missing_ids:
+                        print(f"{len(missing_ids)} messages could not be fetched, they will be retried at the next sync")
+                        return
+                    self.save_sync_position(new_emails['historyId'])
+                    return
+                print("Falling back to a full resync")
+
+            # record the position of the mailbox before listing, so that messages received during the sync are picked up next time
+            history_id = self.get_current_history_id()
+
+        list_of_emails = self.build_email_list(search_filter(self.frames.values()))
+
+        missing_ids = []
+        if list_of_emails and 'messages' in list_of_emails:
+            missing_ids = self.pull_images_and_update_queues(list_of_emails)
+
+        if missing_ids:
+            print(f"{len(missing_ids)} messages could not be fetched, they will be retried at the next sync")
+        elif self.incremental and history_id and list_of_emails is not None:
+            self.save_sync_position(history_id)
     
-    def display_from_queue(self, target : str):
-         # target is either "satellite_frame" or "earth_frame"
+    def get_image_to_display(self, target : str):
+        # target is the name of a frame
         
-        # get all dates in relevant queue
-        dates_in_queue = [item.display_date for item in self.image_queues[target]._elements]
-
-        # go to first date in queue that is today or later
-        for index, item in enumerate(dates_in_queue):
-            if item >= DATE_NOW:
-                break
-        
-       # get image to display
-        image = self.image_queues[target]._elements[index]
-        output_text = image.text
-        image_to_send = self.pull_specific_image(image.temporary_attachment_id, image.message_id)
-
-        # save queue to file and create dir if it doesn't exist 
-        if not os.path.exists(dir_path + '/queues'):
-            os.makedirs(dir_path + '/queues')
-
-        self.image_queues[target].save_to_file(os.path.join(dir_path, 'queues', f'{target}_queue.json'))
-
-        return(image_to_send,output_text) # return image and body of first email relevant to the initiator
-    
\ No newline at end of file
+       # get details of the first image to display today or later (None if the queue is empty)
+        with self.queue_locks.get(target):
+            return self.get_queue(target).find_by_date(self.clock())
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Long-lived Gmail API clients, shared by all the requests served by the app
+
+import os
+import json
+import threading
+
+import httplib2
+import google_auth_httplib2
+from googleapiclient.discovery import build_from_document
+
+# find script directory
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+# Static copy of https://gmail.googleapis.com/$discovery/rest?version=v1 shipped with the app,
+# so that no request has to download or re-parse it
+DISCOVERY_FILE = os.path.join(dir_path, 'discovery', 'gmail.v1.json')
+
+# timeout of the HTTP connections to the Gmail API, in seconds
+HTTP_TIMEOUT = 30
+
+
+class GmailServicePool():
+    # httplib2 is not thread-safe and gunicorn serves requests from several threads,
+    # so every thread keeps its own authorized client. The client is reused across requests,
+    # which keeps its connection to Gmail alive.
+
+    def __init__(self, discovery_file : str = DISCOVERY_FILE, timeout : int = HTTP_TIMEOUT):
+        # parse the discovery document once per process
+        with open(discovery_file, 'r') as file:
+            self.discovery_document = json.load(file)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self, creds):
+        # build a client for this thread the first time, or when the credentials object is replaced (after a new auth flow)
+        if getattr(self._local, 'creds', None) is not creds:
+            authorized_http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=self.timeout))
+            self._local.service = build_from_document(self.discovery_document, http=authorized_http)
+            self._local.creds = creds
+
+        return self._local.service
+
+
+# one pool per process
+service_pool = GmailServicePool()
@@ -3,19 +3,27 @@
 
 import os
 import flask
-from flask import send_file
 import requests
 import json
+import hashlib
+import threading
+import time
 from io import BytesIO
+from PIL import Image
 
 #google libraries
 import google_auth_oauthlib.flow
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
 
 #local functions
 from eink_image import Image_transform
-from gmail_connector import GmailConnector
+from dithering import DITHER_MODES
+from framebuffer import to_framebuffer, compress, COMPRESSIONS, FRAMEBUFFER_MIMETYPE
+from gmail_connector import GmailConnector, today
+from frame_cache import FrameCache
+from credential_manager import CredentialManager
+from queue_store import JsonQueueStore, SqliteQueueStore
+from single_flight import SingleFlight
+from frame_registry import load_frames
 
 
 # find script directory
@@ -35,6 +43,36 @@ SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 API_SERVICE_NAME = 'gmail'
 #API_VERSION = 'v3'
 
+#credentials kept in memory and refreshed in the background
+credential_manager = CredentialManager(TOKEN_FILE, SCOPES)
+
+#cache of the rendered frames, shared by all the threads of the app
+frame_cache = FrameCache()
+
+#the queues are kept in a SQLite database, the json files of previous versions are imported the first time
+queue_store = SqliteQueueStore()
+queue_store.migrate_from_json(JsonQueueStore())
+
+#the Gmail connector is created on the first frame request and reused by the next ones
+gmail_inbox = None
+#the connector is shared by all the threads of the app
+gmail_inbox_lock = threading.Lock()
+#the inbox is scanned by one thread at a time, the queues of the frames are locked by the connector
+inbox_lock = threading.Lock()
+#concurrent requests for the same frame wait for a single sync and render
+frame_requests = SingleFlight()
+
+#the inbox is synced in the background every INGEST_INTERVAL seconds, and new images are rendered right away
+#on Cloud Run, this needs the "CPU always allocated" option, otherwise the sync mostly happens at the next request
+INGEST_INTERVAL = 300
+#frames served by the app, with the senders, queue length and layout of each of them (see frame_registry.py)
+FRAMES = load_frames()
+ingest_thread = None
+#the first requests of different frames can try to start it at the same time
+ingest_thread_lock = threading.Lock()
+#set once the inbox was scanned since the app started
+inbox_synced = threading.Event()
+
 ##FLASK APP
 app = flask.Flask(__name__)
    
@@ -45,91 +83,188 @@ with open(FLASK_KEY) as secrets_file:
 
 
 def generate_credentials():
-  #if there are stored credentials, retrieve them
-  credentials = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
-  
-  #if credentials are expired, refresh
-  if not credentials.valid:
-    credentials.refresh(Request())
-    print("Credentials refreshed!")
-        
-    #Save credentials to file if they were refreshed 
-    with open(TOKEN_FILE, 'w') as token:
-      token.write(credentials.to_json())
-      print("Credentials saved to file!")
-
-  return credentials
-  
-def pull_and_display_image(target, creds):
+  #if there are stored credentials, retrieve them (None otherwise)
+  #they are refreshed ahead of expiry by the credential manager
+  return credential_manager.get()
   
-  # initialize connector
-  gmail_inbox =  GmailConnector(creds=creds, length_of_queue = 10, satellite_emails = ["EMAIL_USED_BY_SATELLITE_FRAME"] )
-
-  # pull attachments
-  gmail_inbox.pull_attachments(target=target)
-
-  # get the image to send
-  image_to_send, output_text = gmail_inbox.display_from_queue(target=target)
- 
-  #transform image into a low res format for the eink screen
-  transformed_image = Image_transform(imported_image=image_to_send, fit="crop", message=output_text)
-  transformed_image = transformed_image.render()
+def render_frame(image, text, frame_config, fit=None, dither_mode=None):
+  #transform image into a low res format for the eink screen of the frame, with the layout of the frame unless another one is asked
+  fit = fit or frame_config.fit
+  transformed_image = Image_transform(imported_image=image, fit=fit, message=text, dither_mode=dither_mode or frame_config.dither)
+  transformed_image = transformed_image.render(fit=fit, size=frame_config.size)
   output = BytesIO()
   transformed_image.save(output, "PNG")
+  return output.getvalue()
+
+def get_gmail_inbox(creds):
+  global gmail_inbox
+
+  with gmail_inbox_lock:
+    # initialize connector
+    if gmail_inbox is None:
+      gmail_inbox =  GmailConnector(creds=creds, frames = FRAMES, incremental = True, render_frame = render_frame, queue_store = queue_store)
+
+    # use the latest credentials (the API clients are only rebuilt when the token changed)
+    if gmail_inbox.creds.token != creds.token:
+      gmail_inbox.creds = creds
+    return gmail_inbox
+
+def ingest(creds, render_frames=True, only_once=False):
+  # pull the new emails and update the queues of all the frames, in one scan of the inbox
+  # with only_once, nothing is pulled if the inbox was already scanned since the app started
+  gmail_inbox = get_gmail_inbox(creds)
+  with inbox_lock:
+    if not (only_once and inbox_synced.is_set()):
+      gmail_inbox.pull_attachments()
+      inbox_synced.set()
+
+  # render the new images without blocking the requests
+  if render_frames:
+    for target in FRAMES:
+      gmail_inbox.render_pending_frames(target)
+
+def ingest_loop():
+  # keep the queues and their frames up to date, away from the requests of the frames
+  while True:
+    credentials = generate_credentials()
+    if credentials is not None:
+      try:
+        ingest(credentials)
+      except Exception as e:
+        print(f"Error in ingest_loop: {e}")
+    time.sleep(INGEST_INTERVAL)
+
+def start_ingest_thread():
+  global ingest_thread
+  with ingest_thread_lock:
+    if ingest_thread is None:
+      ingest_thread = threading.Thread(target=ingest_loop, daemon=True)
+      ingest_thread.start()
+
+def pull_and_display_image(frame_config, creds, fit=None, dither_mode=None):
+  # requests for the same frame arriving together (several screens, or a Pi retrying) share the work of the first one
+  # without fit or dither_mode, the layout of frames.json is used
+  fit = fit or frame_config.fit
+  dither_mode = dither_mode or frame_config.dither
+  frame = frame_requests.do((frame_config.name, today(), fit, dither_mode), get_frame, frame_config, creds, fit, dither_mode)
+
+  # nothing was received yet
+  if frame is None:
+    return None
+
+  # display the image
+  # wrap the bytes in a new file object so that every request reads from the beginning
+  return BytesIO(frame)
+
+def get_frame(frame_config, creds, fit, dither_mode):
+  target = frame_config.name
+
+  # after a restart, sync once before answering
+  # the frames of a large backlog are rendered by the ingest thread, this request renders its own frame if needed
+  if not inbox_synced.is_set():
+    ingest(creds, render_frames=False, only_once=True)
+  start_ingest_thread()
+
+  gmail_inbox = get_gmail_inbox(creds)
+  # find the queue entry to display today
+  image_entry = gmail_inbox.get_image_to_display(target=target)
+
+  # nothing was received yet
+  if image_entry is None:
+    return None
+
+  # the rendered frame only depends on the entry, the day and the layout, so reuse it if it was already computed
+  cache_key = FrameCache.make_key(target, image_entry.unique_attachment_id, image_entry.display_date, fit, image_entry.text, dither_mode)
+  frame = frame_cache.get(cache_key)
+
+  # otherwise use the frame rendered at ingest time
+  if frame is None and fit == frame_config.fit and dither_mode == frame_config.dither:
+    frame = gmail_inbox.load_frame(target, image_entry)
+    if frame is not None:
+      frame_cache.put(cache_key, frame, persist=False)
+
+  # otherwise render it now
+  if frame is None:
+    # get the image to send
+    image_to_send = gmail_inbox.pull_specific_image(image_entry.temporary_attachment_id, image_entry.message_id, image_entry.unique_attachment_id)
+    frame = render_frame(image_to_send, image_entry.text, frame_config, fit=fit, dither_mode=dither_mode)
+
+    frame_cache.put(cache_key, frame)
     
-  # display the image (don't cache it)
-  # output.seek resets the pointer to the beginning of the file 
-  output.seek(0)
-  return output
+  return frame
   
 
+def send_frame(output):
+  # the Pi can ask for the packed framebuffer of the panel instead of a PNG, with ?format=epd or with the Accept header
+  # the framebuffer is already rotated and inverted, it can be sent to the panel as is (see framebuffer.py)
+  if flask.request.args.get('format') != 'epd' and FRAMEBUFFER_MIMETYPE not in flask.request.headers.get('Accept', ''):
+    return conditional_response(output.getvalue(), "image/png")
+
+  # optional compression : ?compression=zlib or ?compression=rle
+  compression = flask.request.args.get('compression', 'none')
+  if compression not in COMPRESSIONS:
+    return (f'Unknown compression. Use one of {", ".join(COMPRESSIONS)}.', 400)
+
+  response = conditional_response(compress(to_framebuffer(Image.open(output)), compression), FRAMEBUFFER_MIMETYPE)
+  response.headers['X-EPD-Compression'] = compression
+  return response
+
+
+def conditional_response(body, mimetype):
+  # the ETag is a hash of the body : a client sending it back in If-None-Match gets an empty 304 until the frame changes
+  response = flask.make_response(body)
+  response.headers['Content-Type'] = mimetype
+  response.headers['Cache-Control'] = 'no-cache'
+  response.set_etag(hashlib.sha256(body).hexdigest()[:32])
+  return response.make_conditional(flask.request)
+
+
 # define the index
 @app.route('/')
 def index():
 
   return ('<table>' + 
-          "<tr><td><a href='/satellite_frame''>See the satellite's frame</a></td>" +
-          "<tr><td><a href='/earth_frame'>See the earth's frame</a></td>" +
+          "".join(f"<tr><td><a href='/frame/{name}'>See the {name.replace('_', ' ')}</a></td>" for name in FRAMES) +
           '<tr><td><a href="/authorize">Test the auth flow directly. You will be sent back to the index</a></td>' +
           '<tr><td><a href="/revoke">Revoke current credentials</a></td>' +
           '</td></tr></table>')
 
-# define view for the satellite frame
-@app.route('/satellite_frame')
-def api_route_satellite_frame():
-  
-  #update refresh token if we have a token file
-  if os.path.exists(TOKEN_FILE):
-    credentials = generate_credentials()
+# define view for any frame of frames.json
+@app.route('/frame/<name>')
+def api_route_frame(name):
+
+  #unknown frames get a 404, before asking for credentials
+  if name not in FRAMES:
+    return (f'Unknown frame. Use one of {", ".join(FRAMES)}.', 404)
+
+  #get the credentials if we have a token file
+  credentials = generate_credentials()
   
   #if there are no credentials, redirect to the authorization flow 
-  else:
+  if credentials is None:
      #create a session parameter to send the user to the right view after the auth flow
-     flask.session['view']="satellite_frame"
-     return flask.redirect('authorize')
+     flask.session['view']=name
+     return flask.redirect(flask.url_for('authorize'))
+
+  #the dithering can be picked with ?dither=atkinson (see dithering.py)
+  dither_mode = flask.request.args.get('dither', FRAMES[name].dither)
+  if dither_mode not in DITHER_MODES:
+    return (f'Unknown dithering mode. Use one of {", ".join(DITHER_MODES)}.', 400)
 
   #pull and display image
-  output = pull_and_display_image(target = "satellite_frame", creds = credentials)
-  return send_file(output, mimetype="image/png")
+  output = pull_and_display_image(frame_config = FRAMES[name], creds = credentials, dither_mode = dither_mode)
+  if output is None:
+    return ('No image received yet.', 404)
+  return send_frame(output)
 
+# the routes of the first two frames, still used by the screens set up before /frame/<name>
+@app.route('/satellite_frame')
+def api_route_satellite_frame():
+  return api_route_frame("satellite_frame")
 
-# define view for the earth frame
 @app.route('/earth_frame')
 def api_route_earth_frame():
-
-  #update refresh token if we have a token file
-  if os.path.exists(TOKEN_FILE):
-    credentials = generate_credentials()
-  
-  #if there are no credentials, redirect to the authorization flow 
-  else:
-     #create a session parameter to send the user to the right view after the auth flow
-     flask.session['view']="earth_frame"
-     return flask.redirect('authorize')
-
-  #pull and display image
-  output = pull_and_display_image(target = "earth_frame", creds = credentials)
-  return send_file(output, mimetype="image/png")
+  return api_route_frame("earth_frame")
 
 
 # build the authorization flow
@@ -141,15 +276,7 @@ def authorize():
       flask.session['view']="index"
 
   #if we are just testing the auth flow and the credentials are expired, simply refresh them
-  if os.path.exists(TOKEN_FILE):
-      credentials = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
-      if not credentials.valid:
-          credentials.refresh(Request())
-
-          #Save credentials to file if they were refreshed
-          with open(TOKEN_FILE, 'w') as token:
-              token.write(credentials.to_json())
-
+  if generate_credentials() is not None:
       return flask.redirect(flask.url_for('index'))
     
   #otherwise fetch the full creds
@@ -195,8 +322,7 @@ def oauth2callback():
   credentials = flow.credentials
  
   #save the credentials to file
-  with open(TOKEN_FILE, 'w') as token:
-      token.write(credentials.to_json())
+  credential_manager.set_credentials(credentials)
 
   return flask.redirect(flask.url_for('index'))
 
@@ -205,7 +331,7 @@ def oauth2callback():
 @app.route('/revoke')
 def revoke():
 
-  credentials = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+  credentials = generate_credentials()
 
   revoke = requests.post('https://oauth2.googleapis.com/revoke',
       params={'token': credentials.token},
@@ -213,6 +339,8 @@ def revoke():
 
   status_code = getattr(revoke, 'status_code')
   if status_code == 200:
+    #the revoked credentials are no longer kept in memory
+    credential_manager.clear()
     return('Credentials successfully revoked.' + index())
     
   else:
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Persistent storage of the image queues and of the Gmail sync state
+# The stores work with the dicts produced by EmailImage.to_dict(), in queue order
+
+import os
+import json
+import glob
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# find script directory
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+QUEUE_DIR = os.path.join(dir_path, 'queues')
+
+
+class JsonQueueStore():
+    # One json file per target, mapping the positions 1, 2, ... to the images. The whole file is rewritten when its queue changes.
+
+    def __init__(self, queue_dir : str = QUEUE_DIR):
+        self.queue_dir = queue_dir
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def _queue_path(self, target : str):
+        return os.path.join(self.queue_dir, f'{target}_queue.json')
+
+    def _history_path(self, target : str):
+        return os.path.join(self.queue_dir, f'{target}_history.json')
+
+    def targets(self):
+        # targets that have a queue file
+        return [os.path.basename(path)[:-len('_queue.json')] for path in glob.glob(os.path.join(self.queue_dir, '*_queue.json'))]
+
+    def load(self, target : str):
+        with self._lock:
+            if os.path.exists(self._queue_path(target)):
+                with open(self._queue_path(target), 'r') as file:
+                    # Ignore the keys and only use the values
+                    self._queues[target] = list(json.load(file).values())
+            else:
+                self._queues[target] = []
+            return [dict(element) for element in self._queues[target]]
+
+    def enqueue(self, target : str, element : dict, dequeued_id : str = None):
+        # add an element at the end of the queue, and remove the element dequeued to make room for it
+        with self._lock:
+            elements = self._elements(target)
+            if dequeued_id is not None:
+                elements[:] = [item for item in elements if item["unique_attachment_id"] != dequeued_id]
+            elements.append(dict(element))
+            self._write(target)
+
+    def update(self, target : str, element : dict):
+        with self._lock:
+            elements = self._elements(target)
+            elements[:] = [dict(element) if item["unique_attachment_id"] == element["unique_attachment_id"] else item for item in elements]
+            self._write(target)
+
+    def attachment_ids(self):
+        # unique_attachment_ids of every queue
+        attachment_ids = set()
+        for target in self.targets():
+            with self._lock:
+                attachment_ids.update(item["unique_attachment_id"] for item in self._elements(target))
+        return attachment_ids
+
+    def load_history_id(self, target : str):
+        # the historyId is stored next to the queue files
+        if os.path.exists(self._history_path(target)):
+            with open(self._history_path(target), 'r') as file:
+                return json.load(file).get('historyId')
+        return None
+
+    def save_history_id(self, target : str, history_id : str):
+        os.makedirs(self.queue_dir, exist_ok=True)
+        with open(self._history_path(target) + '.tmp', 'w') as file:
+            json.dump({"historyId": history_id}, file)
+        os.replace(self._history_path(target) + '.tmp', self._history_path(target))
+
+    def _elements(self, target : str):
+        # called with the lock held
+        if target not in self._queues:
+            self._queues[target] = []
+            if os.path.exists(self._queue_path(target)):
+                with open(self._queue_path(target), 'r') as file:
+                    self._queues[target] = list(json.load(file).values())
+        return self._queues[target]
+
+    def _write(self, target : str):
+        # called with the lock held
+        os.makedirs(self.queue_dir, exist_ok=True)
+        with open(self._queue_path(target) + '.tmp', 'w') as file:
+            json.dump({i+1: element for i, element in enumerate(self._queues[target])}, file)
+        os.replace(self._queue_path(target) + '.tmp', self._queue_path(target))
+
+
+class SqliteQueueStore():
+    # All the queues in one SQLite database in WAL mode : every change is a small transaction that only touches
+    # the rows that changed, and concurrent threads or workers can't overwrite each other's changes.
+
+    def __init__(self, database_path : str = os.path.join(QUEUE_DIR, 'queues.sqlite3')):
+        self.database_path = database_path
+        # sqlite connections can't be shared between threads
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(database_path), exist_ok=True)
+        with self._transaction() as connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS queue_entries (
+                                    target TEXT NOT NULL,
+                                    position INTEGER NOT NULL,
+                                    unique_attachment_id TEXT NOT NULL,
+                                    temporary_attachment_id TEXT,
+                                    message_id TEXT,
+                                    text TEXT,
+                                    display_date TEXT,
+                                    frame_file TEXT,
+                                    PRIMARY KEY (target, unique_attachment_id))''')
+            connection.execute('CREATE INDEX IF NOT EXISTS queue_entries_position ON queue_entries (target, position)')
+            connection.execute('CREATE TABLE IF NOT EXISTS sync_state (target TEXT PRIMARY KEY, history_id TEXT)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # transactions are handled explicitly in _transaction
+            connection = sqlite3.connect(self.database_path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        # take the write lock right away, so that two writers never interleave
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def targets(self):
+        return [row['target'] for row in self._connection().execute('SELECT DISTINCT target FROM queue_entries')]
+
+    def load(self, target : str):
+        rows = self._connection().execute('''SELECT unique_attachment_id, temporary_attachment_id, message_id, text, display_date, frame_file
+                                             FROM queue_entries WHERE target = ? ORDER BY position''', (target,))
+        return [dict(row) for row in rows]
+
+    def enqueue(self, target : str, element : dict, dequeued_id : str = None):
+        # add an element at the end of the queue, and remove the element dequeued to make room for it, in one transaction
+        with self._transaction() as connection:
+            if dequeued_id is not None:
+                connection.execute('DELETE FROM queue_entries WHERE target = ? AND unique_attachment_id = ?', (target, dequeued_id))
+            position = connection.execute('SELECT COALESCE(MAX(position), 0) + 1 FROM queue_entries WHERE target = ?', (target,)).fetchone()[0]
+            connection.execute('''INSERT OR REPLACE INTO queue_entries
+                                  (target, position, unique_attachment_id, temporary_attachment_id, message_id, text, display_date, frame_file)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                               (target, position, element["unique_attachment_id"], element["temporary_attachment_id"], element["message_id"],
+                                element["text"], element["display_date"], element.get("frame_file")))
+
+    def update(self, target : str, element : dict):
+        with self._transaction() as connection:
+            connection.execute('''UPDATE queue_entries SET temporary_attachment_id = ?, message_id = ?, text = ?, display_date = ?, frame_file = ?
+                                  WHERE target = ? AND unique_attachment_id = ?''',
+                               (element["temporary_attachment_id"], element["message_id"], element["text"], element["display_date"],
+                                element.get("frame_file"), target, element["unique_attachment_id"]))
+
+    def attachment_ids(self):
+        return {row['unique_attachment_id'] for row in self._connection().execute('SELECT unique_attachment_id FROM queue_entries')}
+
+    def load_history_id(self, target : str):
+        row = self._connection().execute('SELECT history_id FROM sync_state WHERE target = ?', (target,)).fetchone()
+        return row['history_id'] if row else None
+
+    def save_history_id(self, target : str, history_id : str):
+        with self._transaction() as connection:
+            connection.execute('INSERT OR REPLACE INTO sync_state (target, history_id) VALUES (?, ?)', (target, history_id))
+
+    def migrate_from_json(self, json_store : JsonQueueStore):
+        # import the queues written by JsonQueueStore, then rename the json files
+        # so that the migration only happens once
+        for target in json_store.targets():
+            elements = json_store.load(target)
+            history_id = json_store.load_history_id(target)
+
+            with self._transaction() as connection:
+                # never overwrite a queue that already lives in the database
+                if connection.execute('SELECT 1 FROM queue_entries WHERE target = ? LIMIT 1', (target,)).fetchone() is None:
+                    for position, element in enumerate(elements, start=1):
+                        connection.execute('''INSERT OR REPLACE INTO queue_entries
+                                              (target, position, unique_attachment_id, temporary_attachment_id, message_id, text, display_date, frame_file)
+                                              VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                                           (target, position, element["unique_attachment_id"], element["temporary_attachment_id"], element["message_id"],
+                                            element["text"], element["display_date"], element.get("frame_file")))
+                    if history_id:
+                        connection.execute('INSERT OR REPLACE INTO sync_state (target, history_id) VALUES (?, ?)', (target, history_id))
+
+            print(f"Migrated {len(elements)} elements of the {target} queue to {self.database_path}")
+            os.replace(json_store._queue_path(target), json_store._queue_path(target) + '.migrated')
+            if os.path.exists(json_store._history_path(target)):
+                os.replace(json_store._history_path(target), json_store._history_path(target) + '.migrated')
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# Coalescing of concurrent identical work, and locks per target
+
+import threading
+
+
+class _Call():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    # Concurrent calls with the same key share a single execution of the function : the first caller runs it,
+    # the others wait for it and get the same result (or the same exception).
+    # Calls made after it finished run the function again.
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class KeyedLocks():
+    # one lock per key (e.g. per target), created on first use
+
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Caption of the frames : fonts loaded once per process, text wrapped to a width in pixels,
+# and captions rendered once into 1-bit layers that are pasted on any frame
+
+import os
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+# find script directory
+dir_path = os.path.dirname(os.path.realpath(__file__))
+font_dir = os.path.join(dir_path, "fonts")
+
+DEFAULT_FONT = "Roboto-Medium.ttf"
+DEFAULT_SIZE = 25
+# space left on each side of the caption
+MARGIN = 20
+# captions kept rendered : the same few messages stay on the frames for days
+MAX_CAPTIONS = 64
+
+
+@lru_cache(maxsize=None)
+def get_font(name : str = DEFAULT_FONT, size : int = DEFAULT_SIZE):
+    return ImageFont.truetype(os.path.join(font_dir, name), size)
+
+
+def wrap_text(text : str, font, max_width : float):
+    # greedy wrap on the width of the rendered words, lines that were already in the text are kept
+    lines = []
+    space = font.getlength(" ")
+    for paragraph in text.split("\n"):
+        line = []
+        line_width = 0
+        for word in paragraph.split():
+            word_width = font.getlength(word)
+            # a word wider than the frame is cut wherever it overflows
+            while word_width > max_width:
+                cut = len(word) - 1
+                while cut > 1 and font.getlength(word[:cut]) > max_width:
+                    cut -= 1
+                if line:
+                    lines.append(" ".join(line))
+                lines.append(word[:cut])
+                line, line_width = [], 0
+                word = word[cut:]
+                word_width = font.getlength(word)
+
+            if line and line_width + space + word_width > max_width:
+                lines.append(" ".join(line))
+                line, line_width = [], 0
+            line_width += (space if line else 0) + word_width
+            line.append(word)
+        lines.append(" ".join(line))
+    return "\n".join(lines)
+
+
+@lru_cache(maxsize=MAX_CAPTIONS)
+def caption_layer(message : str, font_name : str = DEFAULT_FONT, size : int = DEFAULT_SIZE, width : int = 480):
+    # ("1" mask of the text pixels, top left corner on the frame), or None without a message
+    # The layers are shared between threads : don't draw on them.
+    if not message.strip():
+        return None
+    font = get_font(font_name, size)
+    text = wrap_text(message, font, width - 2 * MARGIN)
+
+    # lines are centered on each other, the block is centered on the frame
+    left, top, right, bottom = ImageDraw.Draw(Image.new("1", (1, 1))).multiline_textbbox((0, 0), text, font=font, align="center")
+    layer = Image.new("1", (width, bottom), 0)
+    ImageDraw.Draw(layer).multiline_text(((width - right) / 2, 0), text, font=font, fill=1, align="center")
+
+    # keep only the pixels of the text, so that the paste touches as few pixels as possible
+    box = layer.getbbox()
+    if box is None:
+        return None
+    return layer.crop(box), box[:2]
+
+
+def draw_caption(canvas : Image, message : str, font_name : str = DEFAULT_FONT, size : int = DEFAULT_SIZE):
+    # black text at the top of the frame
+    caption = caption_layer(message, font_name, size, canvas.size[0])
+    if caption is not None:
+        mask, position = caption
+        canvas.paste(0, position, mask)
+    return canvas